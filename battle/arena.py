@@ -1,9 +1,43 @@
+from collections import defaultdict
 from dataclasses import dataclass, field, replace
-from math import atan2, cos, pi, sin, sqrt
+from math import hypot, sqrt
 from random import random
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from battle.robots import GameParameters, Missile, Robot, RobotCommand, RobotCommandType
+from battle.robots import GameParameters, Missile, Robot, RobotCommand, RobotCommandType, unit_vector
+
+# Radar targets are bucketed into a grid with this many cells along each side of the arena
+RADAR_GRID_CELLS = 5
+# Robots are bucketed into a grid of this cell size for missile collision detection
+COLLISION_GRID_SIZE = 200
+
+
+def outside_sweep(
+    corners: List[Tuple[float, float]], ax: float, ay: float, bx: float, by: float, direction: float
+) -> bool:
+    """Returns whether all the points, relative to a radar, are outside the half-turn or less that it swept from
+    direction (ax, ay) to (bx, by). `direction` is 1 for an anticlockwise sweep or -1 for a clockwise one."""
+    return all(direction * (ax * y - ay * x) <= 0 for x, y in corners) or all(
+        direction * (x * by - y * bx) <= 0 for x, y in corners
+    )
+
+
+def sweep_hit_time(x: float, y: float, dx: float, dy: float, radius: float) -> Optional[float]:
+    """Returns the earliest fraction of a step, between 0 and 1, at which a point starting at (x, y) relative to the
+    centre of a circle and moving (dx, dy) relative to it during the step is inside the circle, or None if it never
+    is. This stops fast missiles from passing through robots between frames."""
+    c = x * x + y * y - radius * radius
+    if c < 0:
+        return 0.0
+    a = dx * dx + dy * dy
+    if a == 0:
+        return None
+    b = x * dx + y * dy
+    discriminant = b * b - a * c
+    if b >= 0 or discriminant < 0:
+        return None
+    t = (-b - sqrt(discriminant)) / a
+    return t if t <= 1 else None
 
 
 @dataclass
@@ -14,21 +48,39 @@ class Arena:
     missiles: List[Missile] = field(default_factory=list)
     winner: Optional[str] = None
     remaining: int = 6000
+    width: int = GameParameters.ARENA_WIDTH
+    height: int = GameParameters.ARENA_HEIGHT
+
+    # Not a field, so it isn't serialized. Headless simulations turn this off to avoid flooding the console.
+    verbose = True
 
     def __post_init__(self):
         self._prior_radar_angle: Dict[str, float] = {}
+        # The distance robots have moved while accelerating over several frames at once, and how many frames that took,
+        # so that they don't move the whole way at their final velocity
+        self._accelerated: Dict[str, Tuple[float, float, int]] = {}
 
-    def update_robot_command(self, robot: Robot, command: RobotCommand) -> None:
-        """Updates the state of the arena and a single robot based on a command"""
+    def update_robot_command(self, robot: Robot, command: RobotCommand, ticks: int = 1) -> None:
+        """Updates the state of the arena and a single robot based on a command, which is applied for `ticks` frames.
+        FIRE only fires once however many frames are taken."""
         # print(f"{robot.name} chose to {command.command_type.name}({command.parameter})")
         if command.command_type is RobotCommandType.ACCELERATE:
-            vx = robot.velocity * cos(robot.velocity_angle / 180 * pi)
-            vy = robot.velocity * sin(robot.velocity_angle / 180 * pi)
-            dx = GameParameters.MOTOR_POWER / GameParameters.COMMAND_RATE * cos(robot.hull_angle / 180 * pi)
-            dy = GameParameters.MOTOR_POWER / GameParameters.COMMAND_RATE * sin(robot.hull_angle / 180 * pi)
-            robot.velocity = sqrt((vx + dx) ** 2 + (vy + dy) ** 2)
-            robot.velocity_angle = atan2(vy + dy, vx + dx) / pi * 180
-            robot.velocity = min(GameParameters.MAX_VELOCITY, robot.velocity)
+            vx, vy = robot.velocity_vector()
+            hx, hy = robot.heading()
+            power = GameParameters.MOTOR_POWER / GameParameters.COMMAND_RATE
+            dx, dy, moved_ticks = self._accelerated.get(robot.name, (0.0, 0.0, 0))
+            for _ in range(ticks):
+                vx += power * hx
+                vy += power * hy
+                # Limit the speed, keeping the direction
+                speed = hypot(vx, vy)
+                if speed > GameParameters.MAX_VELOCITY:
+                    vx *= GameParameters.MAX_VELOCITY / speed
+                    vy *= GameParameters.MAX_VELOCITY / speed
+                dx += vx
+                dy += vy
+            robot.set_velocity_vector(vx, vy)
+            self._accelerated[robot.name] = (dx, dy, moved_ticks + ticks)
             if robot.accelerate_progress is None:
                 robot.accelerate_progress = 0
         elif command.command_type is RobotCommandType.FIRE:
@@ -40,15 +92,15 @@ class Arena:
             energy = max(0, energy)
             angle = (robot.hull_angle + robot.turret_angle) % 360
             robot.weapon_energy = max(0, robot.weapon_energy - energy)
-            start_position = replace(robot.position)
-            start_position.x += 1.01 * robot.radius * cos(angle / 180 * pi)
-            start_position.y += 1.01 * robot.radius * sin(angle / 180 * pi)
-            m = Missile(start_position, angle, energy)
+            m = Missile(replace(robot.position), angle, energy)
+            dx, dy = m.direction()
+            m.position.x += 1.01 * robot.radius * dx
+            m.position.y += 1.01 * robot.radius * dy
             self.missiles.append(m)
             if robot.firing_progress is None:
                 robot.firing_progress = 0
         elif command.command_type is RobotCommandType.TURN_HULL:
-            robot.hull_angle += min(
+            robot.hull_angle += ticks * min(
                 GameParameters.MAX_TURN_ANGLE,
                 max(-GameParameters.MAX_TURN_ANGLE, command.parameter / GameParameters.COMMAND_RATE),
             )
@@ -56,52 +108,55 @@ class Arena:
             if robot.accelerate_progress is None:
                 robot.accelerate_progress = 0
         elif command.command_type is RobotCommandType.TURN_TURRET:
-            robot.turret_angle += command.parameter / GameParameters.COMMAND_RATE
+            robot.turret_angle += ticks * command.parameter / GameParameters.COMMAND_RATE
             robot.turret_angle %= 360
         elif command.command_type is RobotCommandType.TURN_RADAR:
-            robot.radar_angle += min(
+            robot.radar_angle += ticks * min(
                 GameParameters.MAX_TURN_RADAR_ANGLE,
                 max(-GameParameters.MAX_TURN_RADAR_ANGLE, command.parameter / GameParameters.COMMAND_RATE),
             )
             robot.radar_angle %= 360
 
-    def update_robot_state(self, robot: Robot) -> None:
+    def update_robot_state(self, robot: Robot, ticks: int = 1) -> None:
         # Update robot position
         old_position = replace(robot.position)
-        robot.position.x += robot.velocity * cos(robot.velocity_angle / 180 * pi)
-        robot.position.y += robot.velocity * sin(robot.velocity_angle / 180 * pi)
-        if robot.position.clip(margin=robot.radius):
+        vx, vy = robot.velocity_vector()
+        # Frames spent accelerating are moved frame by frame, and any others at the final velocity
+        dx, dy, moved_ticks = self._accelerated.pop(robot.name, (0.0, 0.0, 0))
+        robot.position.x += dx + (ticks - moved_ticks) * vx
+        robot.position.y += dy + (ticks - moved_ticks) * vy
+        if robot.position.clip(margin=robot.radius, width=self.width, height=self.height):
             robot.bumped_wall = True
             if abs(robot.velocity) > 0.001:
                 effective_v = robot.position - old_position
-                robot.velocity = abs(effective_v)
-                robot.velocity_angle = effective_v.angle()
+                robot.set_velocity_vector(effective_v.x / ticks, effective_v.y / ticks)
 
         # Recharge weapon
-        robot.weapon_energy += GameParameters.WEAPON_RECHARGE_RATE
+        robot.weapon_energy += ticks * GameParameters.WEAPON_RECHARGE_RATE
         robot.weapon_energy = min(GameParameters.MAX_DAMAGE, robot.weapon_energy)
 
         # Manage turret firing progress for animations
         if robot.firing_progress is not None:
-            robot.firing_progress += 1
+            robot.firing_progress += ticks
             if robot.firing_progress >= GameParameters.FIRING_FRAMES:
                 robot.firing_progress = None
 
         # Manage exhaust progress for animations
         if robot.accelerate_progress is not None:
-            robot.accelerate_progress += 1
+            robot.accelerate_progress += ticks
             if robot.accelerate_progress >= GameParameters.EXHAUST_FRAMES:
                 robot.accelerate_progress = None
 
-    def update_missile(self, missile: Missile) -> None:
+    def update_missile(self, missile: Missile, ticks: int = 1) -> None:
         """Updates the state of a single missile"""
         if missile.exploding:
-            missile.explode_progress += 1
+            missile.explode_progress += ticks
         else:
-            v = GameParameters.BULLET_VELOCITY
-            missile.position.x += v * cos(missile.angle / 180 * pi)
-            missile.position.y += v * sin(missile.angle / 180 * pi)
-            missile.position.clip()
+            v = ticks * GameParameters.BULLET_VELOCITY
+            dx, dy = missile.direction()
+            missile.position.x += v * dx
+            missile.position.y += v * dy
+            missile.position.clip(width=self.width, height=self.height)
 
     def reset_flags(self):
         for robot in self.robots:
@@ -112,75 +167,138 @@ class Arena:
             robot.bumped_wall = False
 
     def update_radars(self) -> None:
+        """Pings each radar that swept past another robot since the last update, with the distance to the first
+        robot it passed in the robot list. Robots are bucketed into a grid, so that whole cells outside a radar's
+        sweep can be skipped, rather than checking every robot against every other robot."""
+        cell_width = self.width / RADAR_GRID_CELLS
+        cell_height = self.height / RADAR_GRID_CELLS
+        cells: Dict[Tuple[int, int], List[Tuple[int, Robot]]] = defaultdict(list)
+        for i, target in enumerate(self.robots):
+            if target.live():
+                cells[int(target.position.x // cell_width), int(target.position.y // cell_height)].append((i, target))
+
         for robot in self.robots:
             if not robot.live():
                 continue
 
-            if robot.name in self._prior_radar_angle:
-                # Update radar pings
-                for target in self.robots:
-                    if robot is target or not target.live():
-                        continue
-
-                    base_angle = self._prior_radar_angle[robot.name]
-                    target_angle = ((target.position - robot.position).angle() - base_angle + 180.0) % 360.0 - 180.0
-                    now_angle = (
-                        robot.hull_angle + robot.turret_angle + robot.radar_angle - base_angle + 180.0
-                    ) % 360.0 - 180.0
-                    if (
-                        now_angle > 0
-                        and target_angle > 0
-                        and now_angle > target_angle
-                        or now_angle < 0
-                        and target_angle < 0
-                        and now_angle < target_angle
-                    ):
-                        robot.radar_ping = abs(target.position - robot.position)
-                        break
-
+            angle = robot.hull_angle + robot.turret_angle + robot.radar_angle
+            base_angle = self._prior_radar_angle.get(robot.name)
             # Save prior radar state for next calculation
-            self._prior_radar_angle[robot.name] = robot.hull_angle + robot.turret_angle + robot.radar_angle
+            self._prior_radar_angle[robot.name] = angle
+            if base_angle is None:
+                continue
+            sweep = (angle - base_angle + 180.0) % 360.0 - 180.0
+            if sweep == 0:
+                continue
+
+            # Targets are inside the sweep if they are past the prior direction and short of the current one
+            direction = 1.0 if sweep > 0 else -1.0
+            ax, ay = unit_vector(base_angle)
+            bx, by = unit_vector(angle)
+            x0 = robot.position.x
+            y0 = robot.position.y
+            first: Optional[int] = None
+            for (cx, cy), targets in cells.items():
+                left = cx * cell_width - x0
+                top = cy * cell_height - y0
+                corners = [
+                    (left, top),
+                    (left + cell_width, top),
+                    (left, top + cell_height),
+                    (left + cell_width, top + cell_height),
+                ]
+                if outside_sweep(corners, ax, ay, bx, by, direction):
+                    continue
+                for i, target in targets:
+                    if target is robot or first is not None and i > first:
+                        continue
+                    dx = target.position.x - x0
+                    dy = target.position.y - y0
+                    if direction * (ax * dy - ay * dx) > 0 and direction * (dx * by - dy * bx) > 0:
+                        first = i
+                        robot.radar_ping = hypot(dx, dy)
 
-    def update_commands(self, commands: Dict[str, RobotCommand]) -> None:
+    def update_commands(self, commands: Dict[str, RobotCommand], ticks: int = 1) -> None:
         for robot in self.robots:
             if not robot.live():
                 continue
 
             command = commands[robot.name]
-            self.update_robot_command(robot, command)
+            self.update_robot_command(robot, command, ticks)
 
-    def update_arena(self) -> None:
-        """Updates the state of the arena (all robots & missiles)"""
+    def update_arena(self, ticks: int = 1) -> None:
+        """Updates the state of the arena (all robots & missiles) by `ticks` frames. Headless simulations can take
+        several frames at once, since missile collisions are swept along the paths of the missile and robot."""
+        robot_starts = [(robot.position.x, robot.position.y) for robot in self.robots]
+        missile_starts = [(missile.position.x, missile.position.y) for missile in self.missiles]
 
         # Update all robots
         for robot in self.robots:
             if not robot.live():
                 robot.velocity = 0
                 continue
-            self.update_robot_state(robot)
+            self.update_robot_state(robot, ticks)
 
         # Update all missiles
         for missile in self.missiles:
-            self.update_missile(missile)
+            self.update_missile(missile, ticks)
 
-        # Missile - Robot collision detection
-        for missile in self.missiles:
-            for robot in self.robots:
-                if not robot.live():
-                    continue
-                # print(abs(`robot.position - missile.position))
-                if abs(robot.position - missile.position) < robot.radius:
-                    if not missile.exploding:
-                        robot.health -= missile.energy
-                        print(f"{robot.name} was hit! Health={robot.health:.2f} Energy={missile.energy:.2f}")
-                        missile.exploding = True
-                        robot.got_hit = True
-                        break
+        # Robots are bucketed into a grid by where they started, so each missile is only checked against the robots
+        # which could have reached its path
+        cells: Dict[Tuple[int, int], List[Tuple[int, Robot, float, float]]] = defaultdict(list)
+        reach = 0.0
+        for i, (robot, (rx, ry)) in enumerate(zip(self.robots, robot_starts)):
+            if robot.live():
+                reach = max(reach, robot.radius + hypot(robot.position.x - rx, robot.position.y - ry))
+                cells[int(rx // COLLISION_GRID_SIZE), int(ry // COLLISION_GRID_SIZE)].append((i, robot, rx, ry))
+
+        # Missile - Robot collision detection, in the frame of reference of each robot
+        for missile, (mx, my) in zip(self.missiles, missile_starts):
+            if not missile.exploding:
+                hit = None
+                hit_index = 0
+                hit_time = 1.0
+                mdx = missile.position.x - mx
+                mdy = missile.position.y - my
+                x_cells = range(
+                    int((min(mx, mx + mdx) - reach) // COLLISION_GRID_SIZE),
+                    int((max(mx, mx + mdx) + reach) // COLLISION_GRID_SIZE) + 1,
+                )
+                y_cells = range(
+                    int((min(my, my + mdy) - reach) // COLLISION_GRID_SIZE),
+                    int((max(my, my + mdy) + reach) // COLLISION_GRID_SIZE) + 1,
+                )
+                for cx in x_cells:
+                    for cy in y_cells:
+                        for i, robot, rx, ry in cells.get((cx, cy), ()):
+                            if not robot.live():
+                                continue
+                            t = sweep_hit_time(
+                                mx - rx,
+                                my - ry,
+                                mdx - (robot.position.x - rx),
+                                mdy - (robot.position.y - ry),
+                                robot.radius,
+                            )
+                            # Ties go to the robot first in the list, as they would without the grid
+                            if t is not None and (hit is None or t < hit_time or t == hit_time and i < hit_index):
+                                hit = robot
+                                hit_index = i
+                                hit_time = t
+                if hit is not None:
+                    hit.health -= missile.energy
+                    if self.verbose:
+                        print(f"{hit.name} was hit! Health={hit.health:.2f} Energy={missile.energy:.2f}")
+                    missile.exploding = True
+                    hit.got_hit = True
+                    # Explode where the missile met the robot, rather than where it would have ended up
+                    missile.position.x = mx + hit_time * mdx
+                    missile.position.y = my + hit_time * mdy
             if (
                 missile.position.x <= 0
-                or missile.position.x >= GameParameters.ARENA_WIDTH
+                or missile.position.x >= self.width
                 or missile.position.y <= 0
-                or missile.position.y >= GameParameters.ARENA_HEIGHT
+                or missile.position.y >= self.height
             ):
                 # print(f"Missile hit edge: {missile.position}")
                 missile.exploding = True
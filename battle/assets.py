@@ -0,0 +1,79 @@
+import gzip
+from pathlib import Path
+from typing import Callable, Dict
+
+import aiohttp_jinja2
+import jinja2
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # type: ignore
+
+TEMPLATE_PATH = Path(__file__).parent / "templates"
+STATIC_PATH = Path(__file__).parent / "static"
+# Versioned static URLs change whenever the file does, so they can be cached indefinitely
+VERSIONED_CACHE_CONTROL = "public, max-age=31536000, immutable"
+UNVERSIONED_CACHE_CONTROL = "public, max-age=300"
+# Compressed variants are only kept if they are at most this fraction of the original size
+MAX_COMPRESSED_RATIO = 0.9
+
+
+def _compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    compressors = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressors[".br"] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def precompress_static(static_path: Path) -> None:
+    """Writes gzip (and brotli, if available) variants alongside each static file, which aiohttp then serves to
+    clients that accept them. Variants which are up to date, or that don't save enough space (such as PNGs) are
+    skipped."""
+    compressors = _compressors()
+    for path in static_path.rglob("*"):
+        if not path.is_file() or path.suffix in compressors:
+            continue
+        data = None
+        for suffix, compress in compressors.items():
+            compressed_path = path.with_name(path.name + suffix)
+            if compressed_path.exists() and compressed_path.stat().st_mtime >= path.stat().st_mtime:
+                continue
+            if data is None:
+                data = path.read_bytes()
+            compressed = compress(data)
+            try:
+                if len(compressed) <= len(data) * MAX_COMPRESSED_RATIO:
+                    compressed_path.write_bytes(compressed)
+                elif compressed_path.exists():
+                    compressed_path.unlink()
+            except OSError as e:
+                print(f"Could not precompress {path}: {e!r}")
+                return
+
+
+async def static_cache_headers(request: web.Request, response: web.StreamResponse) -> None:
+    """Adds cache headers to static file responses. aiohttp already provides ETag and Last-Modified headers."""
+    if getattr(request.match_info.route.resource, "name", None) != "static":
+        return
+    if response.status not in (200, 304):
+        return
+    response.headers["Cache-Control"] = VERSIONED_CACHE_CONTROL if "v" in request.query else UNVERSIONED_CACHE_CONTROL
+    response.headers["Vary"] = "Accept-Encoding"
+
+
+@aiohttp_jinja2.template("index.html.j2")
+async def index_handler(request):
+    return {}
+
+
+def add_site_routes(app: web.Application) -> None:
+    """Adds the spectator web page and static files to the app. The static files are served from the root, so this
+    must be called after all other routes are added."""
+    precompress_static(STATIC_PATH)
+    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(TEMPLATE_PATH))
+    app.on_response_prepare.append(static_cache_headers)
+    app.router.add_get("/", index_handler)
+    app.router.add_get("/game/{arena_id}", index_handler)
+    app.router.add_static("/", STATIC_PATH, name="static", append_version=True)
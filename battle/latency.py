@@ -0,0 +1,64 @@
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+from battle.robots import GameParameters
+
+# Only the most recent samples are kept for calculating percentiles
+MAX_LATENCY_SAMPLES = 2000
+
+
+@dataclass
+class LatencyStats:
+    """Tracks a robot's decision latency, i.e. the time between its state being sent and its next command arriving.
+    Commands arriving after the command window closes miss it, and are counted as late."""
+
+    commands: int = 0
+    late_commands: int = 0
+    samples: Deque[float] = field(default_factory=lambda: deque(maxlen=MAX_LATENCY_SAMPLES))
+    pushed_at: Optional[float] = None
+
+    def state_sent(self, now: float, queued: int) -> None:
+        """Records a state update being sent. Robots with queued commands aren't expected to respond, otherwise the
+        latency is measured from the oldest state update that hasn't been responded to."""
+        if queued:
+            self.pushed_at = None
+        elif self.pushed_at is None:
+            self.pushed_at = now
+
+    def command_received(self, now: float) -> None:
+        """Records the first command received after each state update. Later commands are queued for future command
+        windows, so they aren't a response to that state."""
+        if self.pushed_at is None:
+            return
+        latency = now - self.pushed_at
+        self.pushed_at = None
+        self.commands += 1
+        self.samples.append(latency)
+        if latency > GameParameters.COMMAND_RATE / GameParameters.FPS:
+            self.late_commands += 1
+
+    def percentiles(self) -> Dict[str, Optional[float]]:
+        """Returns the 50th, 90th and 99th percentile and maximum latencies, in milliseconds"""
+        if not self.samples:
+            return {"p50_ms": None, "p90_ms": None, "p99_ms": None, "max_ms": None}
+        ordered = sorted(self.samples)
+
+        def percentile(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+        return {
+            "p50_ms": percentile(0.5),
+            "p90_ms": percentile(0.9),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(ordered[-1] * 1000, 1),
+        }
+
+    def summary(self) -> str:
+        p = self.percentiles()
+        if p["p50_ms"] is None:
+            return "no commands received yet"
+        return (
+            f"p50={p['p50_ms']}ms p90={p['p90_ms']}ms p99={p['p99_ms']}ms max={p['max_ms']}ms, "
+            f"{self.late_commands} of {self.commands} commands late"
+        )
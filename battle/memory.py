@@ -0,0 +1,86 @@
+import sys
+import tracemalloc
+from collections import deque
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
+
+# The number of allocation sites reported from a tracemalloc snapshot diff
+TOP_ALLOCATION_SITES = 25
+TRACEMALLOC_FRAMES = 5
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """Returns the approximate size in bytes of an object and everything it refers to through containers and instance
+    attributes. Shared objects are only counted once, and classes and enum members aren't counted at all."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (type, Enum)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def max_rss_kb() -> Optional[int]:
+    """Returns the peak resident set size of the server process, where the platform reports it"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes rather than kilobytes
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+class AllocationTracer:
+    """Compares tracemalloc snapshots against a baseline, to find the allocation sites responsible for memory growth.
+    Tracing slows down the whole server, so it is only enabled on request."""
+
+    def __init__(self):
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+
+    @staticmethod
+    def snapshot() -> tracemalloc.Snapshot:
+        """Takes a snapshot, leaving out tracemalloc's own allocations"""
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def start(self) -> None:
+        """Starts tracing, if it isn't already, and takes a new baseline snapshot"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.baseline = self.snapshot()
+
+    def stop(self) -> None:
+        self.baseline = None
+        tracemalloc.stop()
+
+    def top_growth(self, limit: int = TOP_ALLOCATION_SITES) -> Optional[List[Dict[str, Any]]]:
+        """Returns the allocation sites which have grown the most since the baseline, or None if not tracing"""
+        baseline = self.baseline
+        if baseline is None:
+            return None
+        try:
+            snapshot = self.snapshot()
+        except RuntimeError:
+            # Tracing was stopped while this was waiting to run
+            return None
+        diffs = snapshot.compare_to(baseline, "traceback")
+        return [
+            {
+                "size_diff": diff.size_diff,
+                "size": diff.size,
+                "count_diff": diff.count_diff,
+                "count": diff.count,
+                "traceback": [f"{frame.filename}:{frame.lineno}" for frame in diff.traceback],
+            }
+            for diff in diffs[:limit]
+        ]
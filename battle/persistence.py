@@ -1,5 +1,12 @@
 from datetime import datetime
 from sqlite3 import PARSE_DECLTYPES, Connection, register_adapter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+EXPORT_COLUMNS = {
+    "match": ("match_id", "arena_id", "end_time", "winner"),
+    "match_stat": ("match_id", "robot_name", "command", "total"),
+    "match_latency": ("match_id", "robot_name", "commands", "late_commands", "p50_ms", "p90_ms", "p99_ms", "max_ms"),
+}
 
 
 def create_connection() -> Connection:
@@ -27,6 +34,36 @@ def create_connection() -> Connection:
             )
         """
         )
+        c.execute(
+            """
+            create table if not exists match_latency (
+                stat_id integer primary key,
+                match_id integer not null references match,
+                robot_name text not null,
+                commands integer not null,
+                late_commands integer not null,
+                p50_ms real,
+                p90_ms real,
+                p99_ms real,
+                max_ms real
+            )
+        """
+        )
+        c.execute("create index if not exists match_arena_idx on match (arena_id, match_id)")
+        c.execute("create index if not exists match_end_time_idx on match (end_time)")
+        c.execute("create index if not exists match_stat_match_idx on match_stat (match_id)")
+        c.execute("create index if not exists match_stat_robot_idx on match_stat (robot_name, match_id)")
+        c.execute("create index if not exists match_latency_match_idx on match_latency (match_id)")
+        c.execute("create index if not exists match_latency_robot_idx on match_latency (robot_name, match_id)")
+        c.execute(
+            """
+            create table if not exists checkpoint (
+                arena_id integer primary key,
+                saved_time datetime not null,
+                state blob not null
+            )
+        """
+        )
     return c
 
 
@@ -45,7 +82,140 @@ def store_match_cmd_stat(c: Connection, match_id: int, robot_name: str, command:
         )
 
 
+def store_match_latency_stat(
+    c: Connection,
+    match_id: int,
+    robot_name: str,
+    commands: int,
+    late_commands: int,
+    percentiles: Dict[str, Optional[float]],
+):
+    values = [percentiles[k] for k in ("p50_ms", "p90_ms", "p99_ms", "max_ms")]
+    with c:
+        c.execute(
+            "insert into match_latency (match_id, robot_name, commands, late_commands, p50_ms, p90_ms, p99_ms, max_ms) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?)",
+            (match_id, robot_name, commands, late_commands, *values),
+        )
+
+
 def get_leaderboard(c: Connection, arena_id: int):
     return c.execute(
         "select winner, count(*) as wins from match where arena_id = ? group by 1 order by 2 desc limit 10", (arena_id,)
     ).fetchall()
+
+
+def store_checkpoint(c: Connection, arena_id: int, saved_time: datetime, state: bytes):
+    with c:
+        c.execute(
+            "insert or replace into checkpoint (arena_id, saved_time, state) values (?, ?, ?)",
+            (arena_id, saved_time, state),
+        )
+
+
+def delete_checkpoint(c: Connection, arena_id: int):
+    with c:
+        c.execute("delete from checkpoint where arena_id = ?", (arena_id,))
+
+
+def get_checkpoints(c: Connection) -> List[Tuple[int, bytes]]:
+    return c.execute("select arena_id, state from checkpoint order by arena_id").fetchall()
+
+
+def _match_filter(
+    arena_id: Optional[int] = None,
+    robot_name: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> Tuple[str, List[Any]]:
+    """Returns a where clause and its parameters, filtering the match table aliased as `m`"""
+    clauses = ["1"]
+    params: List[Any] = []
+    if arena_id is not None:
+        clauses.append("m.arena_id = ?")
+        params.append(arena_id)
+    if robot_name is not None:
+        clauses.append("m.match_id in (select match_id from match_stat where robot_name = ?)")
+        params.append(robot_name)
+    if since is not None:
+        clauses.append("m.end_time >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("m.end_time < ?")
+        params.append(until)
+    return " and ".join(clauses), params
+
+
+def get_match_history(
+    c: Connection,
+    arena_id: Optional[int] = None,
+    robot_name: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    before: Optional[int] = None,
+    limit: int = 100,
+):
+    """Returns matches newest first. Pass the last match_id returned as `before` to get the next page."""
+    where, params = _match_filter(arena_id, robot_name, since, until)
+    if before is not None:
+        where += " and m.match_id < ?"
+        params.append(before)
+    return c.execute(
+        f"select m.match_id, m.arena_id, m.end_time, m.winner from match m where {where} "
+        "order by m.match_id desc limit ?",
+        (*params, limit),
+    ).fetchall()
+
+
+def get_command_totals(
+    c: Connection,
+    arena_id: Optional[int] = None,
+    robot_name: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Returns the number of matches and total number of each command issued, per robot"""
+    where, params = _match_filter(arena_id, None, since, until)
+    if robot_name is not None:
+        where += " and s.robot_name = ?"
+        params.append(robot_name)
+    return c.execute(
+        "select s.robot_name, s.command, count(distinct s.match_id) as matches, sum(s.total) as total "
+        f"from match_stat s join match m on m.match_id = s.match_id where {where} group by 1, 2 order by 1, 2",
+        params,
+    ).fetchall()
+
+
+def iter_export(
+    c: Connection,
+    table: str,
+    arena_id: Optional[int] = None,
+    robot_name: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = 1000,
+) -> Iterator[List[Tuple]]:
+    """Yields the rows of `table` (match, or one of the per-match stat tables) in the order they were stored, in
+    chunks. Each chunk is a separate query continuing from the last row, so no cursor is held open between chunks."""
+    where, params = _match_filter(arena_id, robot_name if table == "match" else None, since, until)
+    if table == "match":
+        key = "m.match_id"
+        source = "match m"
+        columns = ", ".join(f"m.{col}" for col in EXPORT_COLUMNS[table])
+    else:
+        key = "s.stat_id"
+        source = f"{table} s join match m on m.match_id = s.match_id"
+        columns = ", ".join(f"s.{col}" for col in EXPORT_COLUMNS[table])
+        if robot_name is not None:
+            where += " and s.robot_name = ?"
+            params.append(robot_name)
+    last_key = -1
+    while True:
+        rows = c.execute(
+            f"select {key}, {columns} from {source} where {where} and {key} > ? order by {key} limit ?",
+            (*params, last_key, chunk_size),
+        ).fetchall()
+        if not rows:
+            return
+        last_key = rows[-1][0]
+        yield [row[1:] for row in rows]
@@ -9,9 +9,9 @@ import websocket
 from battle.robots import Robot, RobotCommand
 
 
-def play(robot_name: str, robot_secret: str, driver, url: str):
+def play(robot_name: str, robot_secret: str, driver, url: str, latency: bool = False):
     """Connects to the game server at `url` and passes robot state updates to the `driver`, and commands back
-    to the game server"""
+    to the game server. If `latency` is set, the server periodically reports how quickly commands arrive."""
     print(f"Connecting to game API server... ", end="")
     ws = websocket.WebSocket()
     try:
@@ -22,7 +22,7 @@ def play(robot_name: str, robot_secret: str, driver, url: str):
     print("Done!")
 
     try:
-        ws.send(json.dumps({"name": robot_name, "secret": robot_secret}))
+        ws.send(json.dumps({"name": robot_name, "secret": robot_secret, "latency": latency}))
         for msg in ws:
             if not msg:
                 break
@@ -50,8 +50,23 @@ def player_main(robot_name: str, driver):
     """Main entry point for running a robot"""
     argparser = argparse.ArgumentParser()
     argparser.add_argument("name", nargs="?", default=robot_name, help="The name of the player.")
-    argparser.add_argument("--game-id", default=0, help="The game ID to play - default is 0")
+    argparser.add_argument(
+        "--game-id",
+        default=0,
+        help='The game ID to play, or "auto" to be placed in a game by the server - default is 0',
+    )
     argparser.add_argument("--url", default="ws://localhost:8000", help="The game server base URL.")
+    argparser.add_argument(
+        "--large", action="store_true", help="Create the game as a large battle, if it doesn't already exist"
+    )
+    argparser.add_argument(
+        "--lockstep",
+        action="store_true",
+        help="Create the game in lockstep mode, which moves on as soon as every robot has sent a command",
+    )
+    argparser.add_argument(
+        "--latency", action="store_true", help="Show how long the server waits for each command to arrive"
+    )
     argparser.add_argument("--browser", action="store_true", help="Open a browser window to watch the game")
     argparser.add_argument(
         "--secret", type=str, help="A secret to allow reconnect to the same robot in case of disconnect"
@@ -59,16 +74,23 @@ def player_main(robot_name: str, driver):
 
     args = argparser.parse_args()
     url = urljoin(args.url.replace("http", "ws"), f"/api/play/{args.game_id}")
+    query = {"large": args.large, "lockstep": args.lockstep}
+    if any(query.values()):
+        url += "?" + "&".join(f"{key}=1" for key, value in query.items() if value)
     us = urlsplit(args.url)
-    watch_url = f"{us.scheme.replace('ws', 'http')}://{us.netloc}/game/{args.game_id}"
-    print(f"Watch this game at: {watch_url}")
-    if args.browser:
-        webbrowser.open(watch_url)
+    if args.game_id == "auto":
+        # The game isn't known until the server places the player
+        print(f"Watch games at: {us.scheme.replace('ws', 'http')}://{us.netloc}/game/<game ID>")
+    else:
+        watch_url = f"{us.scheme.replace('ws', 'http')}://{us.netloc}/game/{args.game_id}"
+        print(f"Watch this game at: {watch_url}")
+        if args.browser:
+            webbrowser.open(watch_url)
     if args.secret is None:
         secret = str(uuid.UUID(fields=(0, 0, 0, 0, 0, uuid.getnode())))
     else:
         secret = args.secret
     try:
-        play(args.name, secret, driver, url)
+        play(args.name, secret, driver, url, args.latency)
     except KeyboardInterrupt:
         pass
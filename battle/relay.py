@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""relay - serves a battle server's games to spectators, without adding load to the battle server
+
+Each arena being watched is subscribed to once from the upstream battle server, and its frames are fanned out to
+any number of local spectators. Run it in front of a battle server with:
+
+  $ battle-relay --upstream http://some.battlefield.server:8000
+"""
+
+import argparse
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+import aiohttp
+from aiohttp import web
+
+from battle.assets import add_site_routes
+from battle.robots import GameParameters
+from battle.runner import MAX_ARENA_ID, WATCH_COMPRESSION
+from battle.util import SpectatorQueue, SpectatorStalled, playback_rate
+
+# Spectators are kept this many frames behind the newest upstream frame, to smooth out network jitter
+RELAY_DELAY_LINE_LEN = GameParameters.FPS
+RELAY_BUFFER_LEN = GameParameters.FPS * 5
+# Upstream subscriptions without any spectators are closed after this many seconds
+FEED_IDLE_TIMEOUT = 30
+FEED_CHECK_INTERVAL = 10
+LEADERBOARD_CACHE_TIME = 5
+
+
+@dataclass
+class Feed:
+    """A single upstream subscription to an arena, shared by all spectators of that arena"""
+
+    arena_id: int
+    frames: Deque[str] = field(default_factory=lambda: deque(maxlen=RELAY_BUFFER_LEN))
+    # The total number of frames received, so spectators can track their position as old frames are dropped
+    count: int = 0
+    event: asyncio.Event = field(default_factory=asyncio.Event)
+    spectators: int = 0
+    last_active: float = field(default_factory=time.monotonic)
+    upstream_task: Optional[asyncio.Task] = None
+
+    def append(self, frame: str) -> None:
+        self.frames.append(frame)
+        self.count += 1
+        self.event.set()
+        self.event.clear()
+
+    def first(self) -> int:
+        """Returns the index of the oldest buffered frame"""
+        return self.count - len(self.frames)
+
+    def get(self, idx: int) -> str:
+        return self.frames[idx - self.first()]
+
+
+async def upstream_task(feed: Feed, client: aiohttp.ClientSession, upstream: str) -> None:
+    """Receives frames from the upstream server, reconnecting if the connection drops"""
+    url = f"{upstream}/api/watch/{feed.arena_id}"
+    while True:
+        try:
+            async with client.ws_connect(url, compress=15) as ws:
+                print(f"Subscribed to {url}")
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        feed.append(msg.data)
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        print(f"Upstream connection closed with exception {ws.exception()}")
+        except aiohttp.ClientError as e:
+            print(f"Upstream exception: {e!r}")
+        await asyncio.sleep(1)
+
+
+def get_or_create_feed(app: web.Application, arena_id: int) -> Feed:
+    if arena_id < 0 or arena_id > MAX_ARENA_ID:
+        raise web.HTTPNotFound
+    feed = app["feeds"].get(arena_id)
+    if feed is None:
+        feed = Feed(arena_id)
+        feed.upstream_task = asyncio.create_task(upstream_task(feed, app["client"], app["upstream"]))
+        app["feeds"][arena_id] = feed
+    return feed
+
+
+async def feed_reaper_task(feeds: Dict[int, Feed]) -> None:
+    """Periodically closes upstream subscriptions that nobody is watching"""
+    while True:
+        await asyncio.sleep(FEED_CHECK_INTERVAL)
+        now = time.monotonic()
+        for arena_id, feed in list(feeds.items()):
+            if feed.spectators == 0 and now - feed.last_active > FEED_IDLE_TIMEOUT:
+                print(f"Unsubscribing from arena {arena_id}")
+                if feed.upstream_task is not None:
+                    feed.upstream_task.cancel()
+                del feeds[arena_id]
+
+
+async def watch_handler(request):
+    """Sends arena updates from the upstream feed to the client, with the same pacing and catch-up behaviour as the
+    battle server. Viewports and lower frame rates aren't supported, so spectators are sent every robot and missile
+    in every frame."""
+    arena_id = int(request.match_info["arena_id"])
+    feed = get_or_create_feed(request.app, arena_id)
+    ws = web.WebSocketResponse(compress=request.app["watch_compression"])
+    queue = SpectatorQueue(arena_id)
+
+    async def send_updates():
+        idx = None
+        try:
+            while True:
+                # Start near the end of the buffer, or skip ahead if we fell off the start of it
+                if idx is None or idx < feed.first():
+                    idx = max(feed.first(), feed.count - RELAY_DELAY_LINE_LEN)
+                # Wait for the upstream server if we've caught up
+                if idx >= feed.count:
+                    await feed.event.wait()
+                    continue
+                fps_mult = playback_rate(feed.count - RELAY_DELAY_LINE_LEN - idx)
+                queue.put(feed.get(idx))
+                idx += 1
+                await asyncio.sleep(1 / GameParameters.FPS / fps_mult)
+        except SpectatorStalled:
+            await queue.disconnect(request, ws)
+        except Exception as e:
+            print(f"Exception: {e!r}")
+        finally:
+            print("Exiting sender")
+
+    # Counted before the first await, so that an idle feed can't be reaped while the connection is set up
+    feed.spectators += 1
+    send_task = None
+    try:
+        await ws.prepare(request)
+        send_task = asyncio.create_task(send_updates())
+        write_task = asyncio.create_task(queue.run(ws))
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.ERROR:
+                print("ws connection closed with exception %s" % ws.exception())
+    finally:
+        if send_task is not None:
+            send_task.cancel()
+            write_task.cancel()
+        print(f"Spectator sent {queue.sent} frames, dropped {queue.dropped}")
+        feed.spectators -= 1
+        feed.last_active = time.monotonic()
+
+    print("websocket connection closed")
+
+    return ws
+
+
+async def leaderboard_handler(request):
+    """Returns the upstream server's leaderboard, cached briefly"""
+    arena_id = int(request.match_info["arena_id"])
+    if arena_id < 0 or arena_id > MAX_ARENA_ID:
+        raise web.HTTPNotFound
+    cached = request.app["leaderboards"].get(arena_id)
+    if cached is not None and time.monotonic() - cached[0] < LEADERBOARD_CACHE_TIME:
+        return web.json_response(cached[1])
+    try:
+        async with request.app["client"].get(f"{request.app['upstream']}/api/leaderboard/{arena_id}") as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    except aiohttp.ClientError as e:
+        print(f"Upstream exception: {e!r}")
+        raise web.HTTPBadGateway
+    request.app["leaderboards"][arena_id] = (time.monotonic(), data)
+    return web.json_response(data)
+
+
+async def relay_task(
+    upstream: str, bind_addr: str = "127.0.0.1", port: int = 8000, watch_compression: bool = WATCH_COMPRESSION
+) -> None:
+    app = web.Application()
+
+    app["upstream"] = upstream.rstrip("/")
+    app["feeds"] = {}
+    app["leaderboards"] = {}
+    app["watch_compression"] = watch_compression
+
+    app.router.add_get("/api/watch/{arena_id}", watch_handler)
+    app.router.add_get("/api/leaderboard/{arena_id}", leaderboard_handler)
+    add_site_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    async with aiohttp.ClientSession() as client:
+        app["client"] = client
+        site = web.TCPSite(runner, bind_addr, port)
+        await site.start()
+        print(f"Relaying {app['upstream']} on http://{bind_addr}:{port}")
+        reaper = asyncio.create_task(feed_reaper_task(app["feeds"]))
+        try:
+            await asyncio.Future()
+        finally:
+            reaper.cancel()
+            for feed in app["feeds"].values():
+                if feed.upstream_task is not None:
+                    feed.upstream_task.cancel()
+            await runner.cleanup()
+
+
+async def amain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--upstream", default="http://localhost:8000", help="The battle server base URL (default: %(default)s)"
+    )
+    parser.add_argument("--addr", default="127.0.0.1", help="Relay bind address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Relay port (default: 8000)")
+    parser.add_argument(
+        "--no-watch-compression",
+        dest="watch_compression",
+        action="store_false",
+        help="Disable per-message deflate compression of the spectator stream",
+    )
+    args = parser.parse_args()
+    try:
+        await relay_task(args.upstream, args.addr, args.port, args.watch_compression)
+    except KeyboardInterrupt:
+        return
+
+
+def main():
+    asyncio.run(amain())
+
+
+if __name__ == "__main__":
+    main()
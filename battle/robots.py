@@ -1,8 +1,8 @@
 from dataclasses import dataclass, field
 from enum import Enum, auto
-from math import atan2, pi, sqrt
+from math import atan2, cos, degrees, hypot, nan, pi, radians, sin, sqrt
 from random import random
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 
 class GameParameters:
@@ -27,6 +27,12 @@ def random_angle() -> float:
     return random() * 360.0
 
 
+def unit_vector(angle: float) -> Tuple[float, float]:
+    """Returns the unit vector pointing in the direction of `angle` (in degrees)"""
+    rad = radians(angle)
+    return cos(rad), sin(rad)
+
+
 @dataclass
 class Position:
     """A position, used for either robots or missiles"""
@@ -35,18 +41,25 @@ class Position:
     y: float
 
     @classmethod
-    def random(cls) -> "Position":
+    def random(
+        cls, width: float = GameParameters.ARENA_WIDTH, height: float = GameParameters.ARENA_HEIGHT
+    ) -> "Position":
         """Returns a new random position]"""
         return cls(
-            x=random() * GameParameters.ARENA_WIDTH,
-            y=random() * GameParameters.ARENA_HEIGHT,
+            x=random() * width,
+            y=random() * height,
         )
 
-    def clip(self, margin: float = 0.0) -> bool:
+    def clip(
+        self,
+        margin: float = 0.0,
+        width: float = GameParameters.ARENA_WIDTH,
+        height: float = GameParameters.ARENA_HEIGHT,
+    ) -> bool:
         """Updates the position co-ordinates so they are within the bounds of the arena. Returns true if
         changed."""
-        new_x = max(margin, min(GameParameters.ARENA_WIDTH - margin, self.x))
-        new_y = max(margin, min(GameParameters.ARENA_HEIGHT - margin, self.y))
+        new_x = max(margin, min(width - margin, self.x))
+        new_y = max(margin, min(height - margin, self.y))
         if (new_x, new_y) != (self.x, self.y):
             self.x, self.y = (new_x, new_y)
             return True
@@ -92,10 +105,39 @@ class Robot:
     accelerate_progress: Optional[int] = None
     cmd_q_len: Optional[int] = None
 
+    # Angles are in degrees for drivers and spectators, but the engine works with vectors. These caches aren't
+    # dataclass fields so they aren't serialized, and are only recomputed when the angle (or velocity) changes.
+    _heading_angle = nan
+    _heading = (1.0, 0.0)
+    _velocity_key = (0.0, 0.0)
+    _velocity_vector = (0.0, 0.0)
+
     def live(self) -> bool:
         """Returns whether robot is still alive"""
         return self.health > 0
 
+    def heading(self) -> Tuple[float, float]:
+        """Returns the unit vector the hull is facing"""
+        if self.hull_angle != self._heading_angle:
+            self._heading = unit_vector(self.hull_angle)
+            self._heading_angle = self.hull_angle
+        return self._heading
+
+    def velocity_vector(self) -> Tuple[float, float]:
+        """Returns the velocity as x and y components"""
+        if (self.velocity, self.velocity_angle) != self._velocity_key:
+            vx, vy = unit_vector(self.velocity_angle)
+            self._velocity_vector = (self.velocity * vx, self.velocity * vy)
+            self._velocity_key = (self.velocity, self.velocity_angle)
+        return self._velocity_vector
+
+    def set_velocity_vector(self, vx: float, vy: float) -> None:
+        """Sets the velocity and velocity angle from x and y components"""
+        self.velocity = hypot(vx, vy)
+        self.velocity_angle = degrees(atan2(vy, vx))
+        self._velocity_vector = (vx, vy)
+        self._velocity_key = (self.velocity, self.velocity_angle)
+
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> "Robot":
         return cls(position=Position(**d.pop("position")), **d)
@@ -111,10 +153,21 @@ class Missile:
     exploding: bool = False
     explode_progress: int = 0
 
+    # Missiles never turn, so their direction is only calculated once
+    _direction_angle = nan
+    _direction = (1.0, 0.0)
+
     def live(self) -> bool:
         """Returns whether missile has finished exploding"""
         return self.explode_progress < GameParameters.EXPLODE_FRAMES
 
+    def direction(self) -> Tuple[float, float]:
+        """Returns the unit vector the missile is travelling in"""
+        if self.angle != self._direction_angle:
+            self._direction = unit_vector(self.angle)
+            self._direction_angle = self.angle
+        return self._direction
+
 
 class RobotCommandType(Enum):
     ACCELERATE = auto()
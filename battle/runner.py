@@ -2,33 +2,84 @@
 
 import argparse
 import asyncio
+import csv
+import hmac
+import io
 import json
+import pickle
+import signal
+import time
+import tracemalloc
 import uuid
 from collections import defaultdict
 from copy import deepcopy
 from dataclasses import asdict, dataclass, field
 from datetime import datetime, timezone
-from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set
 
 import aiohttp
-import aiohttp_jinja2
-import jinja2
 from aiohttp import web
 
 from battle.arena import Arena
+from battle.assets import add_site_routes
 from battle.chillbot import ChillDriver
-from battle.persistence import Connection, create_connection, get_leaderboard, store_match, store_match_cmd_stat
+from battle.latency import LatencyStats
+from battle.memory import AllocationTracer, deep_sizeof, max_rss_kb
+from battle.persistence import (
+    EXPORT_COLUMNS,
+    Connection,
+    create_connection,
+    delete_checkpoint,
+    get_checkpoints,
+    get_command_totals,
+    get_leaderboard,
+    get_match_history,
+    iter_export,
+    store_checkpoint,
+    store_match,
+    store_match_cmd_stat,
+    store_match_latency_stat,
+)
 from battle.pongbot import PongDriver
 from battle.radarbot import RadarDriver
-from battle.robots import GameParameters, Robot, RobotCommand, RobotCommandType
-from battle.util import state_as_json
+from battle.robots import GameParameters, Position, Robot, RobotCommand, RobotCommandType
+from battle.util import DelayLine, SpectatorQueue, SpectatorStalled, Viewport, playback_rate, state_as_json
 
-TEMPLATE_PATH = Path(__file__).parent / "templates"
-STATIC_PATH = Path(__file__).parent / "static"
 ARENA_STATE_DELAY_LINE_LEN = GameParameters.FPS * 10
 MAX_ARENA_ID = 1000
 MAX_MATCH_PLAYERS = 10
+# Large battle mode, for battle-royale style events
+LARGE_ARENA_WIDTH = 5000
+LARGE_ARENA_HEIGHT = 5000
+LARGE_MATCH_PLAYERS = 300
+# Large battles give players longer to join after the second one arrives
+LARGE_MATCH_WAIT_TIME = 60
+# Each frame of a full large battle is a few hundred KB, so only the frames spectators may still need are kept
+LARGE_DELAY_LINE_LEN = ARENA_STATE_DELAY_LINE_LEN + GameParameters.FPS * 2
+# Finished matches are kept around for a while so spectators can see the result, then evicted
+FINISHED_MATCH_TTL = 10 * 60
+# Matches that never started and have had no connected players for this long are evicted
+ABANDONED_MATCH_TTL = 5 * 60
+# Upper bound on the approximate memory held by the delay lines of all matches, running or not. Frames of large
+# battles cost many times more than those of regular matches, so this is in bytes rather than frames.
+MAX_DELAY_LINE_BYTES = 2 * 1024**3
+EVICTION_INTERVAL = 10
+# Running matches are checkpointed this often, so they can be resumed after a restart
+CHECKPOINT_INTERVAL = 5
+MAX_HISTORY_PAGE_SIZE = 1000
+# Players who ask for latency reports get one this many command windows apart
+LATENCY_ECHO_INTERVAL = 40
+# Players waiting for matchmaking are given a new arena once this many seconds have passed, even if it isn't full
+MATCHMAKING_MAX_WAIT = 10
+MATCHMAKING_INTERVAL = 1
+# Spectators may ask for a lower frame rate, down to this many frames per second, and extrapolate in between
+MIN_STREAM_RATE = 5
+# Whether the watch stream may use permessage-deflate, which aiohttp negotiates by default. Consecutive frames are
+# very similar, so compressing with a shared context across messages typically shrinks them several times over. It
+# can be turned off to save server CPU where bandwidth is cheap.
+WATCH_COMPRESSION = True
+# Without an admin token, admin APIs only answer requests from these addresses
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
 
 
 @dataclass
@@ -37,20 +88,30 @@ class Match:
     min_num_players: int = 2
     wait_time: int = 10
     started: bool = False
+    # Set during the countdown to the start, once enough players have joined
+    starting: bool = False
     finished: bool = False
     allow_late_entrants: bool = False
+    max_players: int = MAX_MATCH_PLAYERS
+    # In lockstep mode each command window ends as soon as every live robot has a command queued
+    lockstep: bool = False
     arena: Arena = field(default_factory=Arena)
     event: asyncio.Event = field(default_factory=asyncio.Event)
     command_queues: Dict[str, List[RobotCommand]] = field(default_factory=dict)
-    arena_state_delay_line: List[Arena] = field(default_factory=list)
+    arena_state_delay_line: DelayLine = field(default_factory=DelayLine)
     player_secrets: Dict[str, str] = field(default_factory=dict)
     player_connected: Dict[str, bool] = field(default_factory=dict)
-    runner_task: asyncio.Task = field(init=False)
+    players_changed: asyncio.Event = field(default_factory=asyncio.Event)
+    commands_queued: asyncio.Event = field(default_factory=asyncio.Event)
+    runner_task: Optional[asyncio.Task] = None
+    # When the battle started or resumed, for pacing spectators of lockstep matches
+    started_at: Optional[float] = None
+    last_active: float = field(default_factory=time.monotonic)
     stats_db: Optional[Connection] = None
     stats: Dict[str, Dict[str, int]] = field(default_factory=lambda: defaultdict(lambda: defaultdict(lambda: 0)))
+    latency: Dict[str, LatencyStats] = field(default_factory=lambda: defaultdict(LatencyStats))
 
     def __post_init__(self):
-        self.runner_task = asyncio.create_task(runner_task(self))
         # For demos, match 0 gets some example bots
         if self.arena_id == 0:
             self.allow_late_entrants = True
@@ -59,6 +120,168 @@ class Match:
             asyncio.create_task(demo_player_task("radarbot", RadarDriver()))
             asyncio.create_task(demo_player_task("chillbot", ChillDriver()))
 
+    def activate(self) -> None:
+        """Starts the runner task for this match, unless it is already running. This is deferred until the
+        first player joins so that idle arenas cost nothing."""
+        if self.runner_task is None:
+            self.runner_task = asyncio.create_task(runner_task(self))
+
+    def touch(self) -> None:
+        """Records activity on this match, postponing its eviction"""
+        self.last_active = time.monotonic()
+
+    def evictable(self, now: float) -> bool:
+        """Returns whether the match is finished or abandoned, and has been idle for long enough to be evicted"""
+        idle = now - self.last_active
+        if self.finished:
+            return idle > FINISHED_MATCH_TTL
+        if not self.started and not any(self.player_connected.values()):
+            return idle > ABANDONED_MATCH_TTL
+        return False
+
+    def close(self) -> None:
+        """Stops the runner task, releases the retained arena states and discards any checkpoint"""
+        if self.runner_task is not None and not self.runner_task.done():
+            self.runner_task.cancel()
+        self.arena_state_delay_line.clear()
+        if self.stats_db:
+            delete_checkpoint(self.stats_db, self.arena_id)
+
+    def add_robot(self, name: str, secret: str) -> None:
+        """Adds a new robot at a random position, dropping any dead robots to make room for it"""
+        num_alive = len([r for r in self.arena.robots if r.live()])
+        if len(self.arena.robots) != num_alive:
+            for r in self.arena.robots[:]:
+                if not r.live():
+                    print(f"Dropping robot {r.name}")
+                    self.arena.robots.remove(r)
+                    self.command_queues.pop(r.name, None)
+        print(f"Adding robot {name}")
+        position = Position.random(self.arena.width, self.arena.height)
+        self.arena.robots.append(Robot(name, position=position))
+        self.command_queues[name] = []
+        self.player_secrets[name] = secret
+
+    def remove_robot(self, name: str) -> None:
+        """Removes a robot that hasn't played yet, along with anything recorded about it"""
+        print(f"Removing robot {name}")
+        self.arena.robots = [r for r in self.arena.robots if r.name != name]
+        self.command_queues.pop(name, None)
+        self.player_secrets.pop(name, None)
+        self.player_connected.pop(name, None)
+        self.stats.pop(name, None)
+        self.latency.pop(name, None)
+        self.players_changed.set()
+
+    def has_room_for(self, name: str) -> bool:
+        """Returns whether a new robot with this name may join"""
+        if self.started and not self.allow_late_entrants:
+            return False
+        if any(r.name == name for r in self.arena.robots):
+            return False
+        return len([r for r in self.arena.robots if r.live()]) < self.max_players
+
+    def commands_ready(self) -> bool:
+        """Returns whether every live robot has a command queued for the next command window"""
+        return all(self.command_queues.get(r.name) for r in self.arena.robots if r.live())
+
+    async def wait_for_commands(self) -> None:
+        """Waits for the current command window to close. In lockstep mode it closes as soon as every live robot has
+        queued a command, but never later than it would otherwise, so slow robots aren't disadvantaged."""
+        timeout = GameParameters.COMMAND_RATE / GameParameters.FPS
+        if not self.lockstep:
+            await asyncio.sleep(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        # Always yield, so nothing else is starved when every robot has commands queued well in advance
+        await asyncio.sleep(0)
+        while not self.commands_ready():
+            try:
+                await asyncio.wait_for(self.commands_queued.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                return
+            self.commands_queued.clear()
+
+    def playback_position(self) -> int:
+        """Returns the delay line index that spectators should be watching. This is normally a fixed distance behind
+        the newest frame. Lockstep matches can run faster than real time, so their spectators watch from the start
+        at normal speed instead, but never closer to the newest frame than usual until the match finishes. Where the
+        delay line is bounded, they skip ahead rather than fall behind the oldest frame kept."""
+        delay_line = self.arena_state_delay_line
+        live_position = len(delay_line) - ARENA_STATE_DELAY_LINE_LEN
+        if not self.lockstep or self.started_at is None:
+            return live_position
+        position = max(int((time.monotonic() - self.started_at) * GameParameters.FPS), delay_line.first)
+        return position if self.finished else min(position, live_position)
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Returns the number of objects held by this match, and their approximate size in bytes. The delay line is
+        estimated from its two newest frames, since sizing every frame would stall the server. Only what the second
+        frame adds to the first is counted for the older frames, as frames share objects such as robot names."""
+        delay_line = self.arena_state_delay_line
+        num_frames = len(delay_line.frames)
+        delay_line_bytes = 0
+        if num_frames:
+            seen: Set[int] = set()
+            delay_line_bytes = deep_sizeof(delay_line[-1], seen)
+            if num_frames > 1:
+                delay_line_bytes += deep_sizeof(delay_line[-2], seen) * (num_frames - 1)
+        return {
+            "arena_id": self.arena_id,
+            "started": self.started,
+            "finished": self.finished,
+            "idle_seconds": round(time.monotonic() - self.last_active, 1),
+            "players": len(self.player_secrets),
+            "robots": len(self.arena.robots),
+            "missiles": len(self.arena.missiles),
+            "delay_line_frames": num_frames,
+            "delay_line_objects": delay_line.objects,
+            "queued_commands": sum(len(q) for q in self.command_queues.values()),
+            "stats_entries": sum(len(cmd_stats) for cmd_stats in self.stats.values()),
+            "latency_samples": sum(len(latency.samples) for latency in self.latency.values()),
+            "approx_bytes": {
+                "arena": deep_sizeof(self.arena),
+                "delay_line": delay_line_bytes,
+                "command_queues": deep_sizeof(self.command_queues),
+                "stats": deep_sizeof(self.stats) + deep_sizeof(self.latency),
+            },
+        }
+
+    def checkpoint(self) -> bytes:
+        """Returns a snapshot of the state needed to resume this match. The delay line isn't included, as it is large
+        and refills before spectators need it again."""
+        state = {
+            "arena_id": self.arena_id,
+            "min_num_players": self.min_num_players,
+            "wait_time": self.wait_time,
+            "started": self.started,
+            "allow_late_entrants": self.allow_late_entrants,
+            "max_players": self.max_players,
+            "lockstep": self.lockstep,
+            "max_delay_line_frames": self.arena_state_delay_line.maxlen,
+            "arena": self.arena,
+            "command_queues": self.command_queues,
+            "player_secrets": self.player_secrets,
+            "stats": {name: dict(cmd_stats) for name, cmd_stats in self.stats.items()},
+        }
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_checkpoint(cls, data: bytes, db: Connection) -> "Match":
+        """Recreates a match from a checkpoint. All players start out disconnected, and may rejoin with their
+        secret."""
+        state = pickle.loads(data)
+        stats = state.pop("stats")
+        # Older checkpoints included the delay line, and weren't bounded
+        frames = state.pop("arena_state_delay_line", [])
+        delay_line = DelayLine(state.pop("max_delay_line_frames", None))
+        for arena in frames:
+            delay_line.append(arena)
+        match = cls(**state, arena_state_delay_line=delay_line, stats_db=db)
+        for name, cmd_stats in stats.items():
+            match.stats[name].update(cmd_stats)
+        return match
+
 
 async def demo_player_task(robot_name: str, driver):
     try:
@@ -82,28 +305,225 @@ async def demo_player_task(robot_name: str, driver):
         print(f"Demo player {robot_name} exception: {e!r}")
 
 
-def get_or_create_match(matches: Dict[int, Match], arena_id: int, recycle: bool, db: Connection) -> Match:
+def get_or_create_match(
+    matches: Dict[int, Match],
+    arena_id: int,
+    recycle: bool,
+    db: Connection,
+    large: bool = False,
+    lockstep: bool = False,
+) -> Match:
+    """Returns the match for the arena, creating a new one if needed. The `large` and `lockstep` flags only apply
+    when a new match is created. `large` gives it a large arena and player cap, and `lockstep` runs it in lockstep
+    mode."""
     if MAX_ARENA_ID < 0 or arena_id > MAX_ARENA_ID:
         raise KeyError(arena_id)
 
     match = matches.get(arena_id)
     if match is None or match.finished and recycle:
-        match = Match(arena_id, stats_db=db)
+        if large:
+            arena = Arena(width=LARGE_ARENA_WIDTH, height=LARGE_ARENA_HEIGHT)
+            match = Match(
+                arena_id,
+                wait_time=LARGE_MATCH_WAIT_TIME,
+                max_players=LARGE_MATCH_PLAYERS,
+                lockstep=lockstep,
+                arena=arena,
+                arena_state_delay_line=DelayLine(LARGE_DELAY_LINE_LEN),
+                stats_db=db,
+            )
+        else:
+            match = Match(arena_id, lockstep=lockstep, stats_db=db)
         matches[arena_id] = match
 
     return matches[arena_id]
 
 
+def evict_matches(matches: Dict[int, Match], now: float) -> List[int]:
+    """Removes finished or abandoned matches whose TTL has expired, then the least recently active finished matches
+    while the delay lines of all matches hold more than the memory budget. Returns the evicted arena IDs."""
+    evicted = [arena_id for arena_id, match in matches.items() if match.evictable(now)]
+    for arena_id in evicted:
+        matches.pop(arena_id).close()
+
+    total_bytes = sum(m.arena_state_delay_line.approx_bytes() for m in matches.values())
+    finished = sorted((m for m in matches.values() if m.finished), key=lambda m: m.last_active)
+    for match in finished:
+        if total_bytes <= MAX_DELAY_LINE_BYTES:
+            break
+        total_bytes -= match.arena_state_delay_line.approx_bytes()
+        matches.pop(match.arena_id).close()
+        evicted.append(match.arena_id)
+    return evicted
+
+
+async def evictor_task(matches: Dict[int, Match]) -> None:
+    """Periodically evicts finished and abandoned matches"""
+    while True:
+        await asyncio.sleep(EVICTION_INTERVAL)
+        for arena_id in evict_matches(matches, time.monotonic()):
+            print(f"Evicted match {arena_id}")
+
+
+@dataclass
+class WaitingPlayer:
+    name: str
+    secret: str
+    placed: asyncio.Future
+    since: float = field(default_factory=time.monotonic)
+
+
+class Matchmaker:
+    """Places players who don't mind which arena they play in. Open arenas are filled fullest first, and a new arena
+    is only opened once enough players are waiting to fill it, or someone has waited for too long. This keeps the
+    number of arenas, and their runner tasks, to a minimum."""
+
+    def __init__(self, matches: Dict[int, Match], db: Connection):
+        self.matches = matches
+        self.db = db
+        self.waiting: List[WaitingPlayer] = []
+        # The arenas opened by the matchmaker, which it may add players to
+        self.arena_ids: Set[int] = set()
+
+    def rejoin(self, name: str, secret: str) -> Optional[Match]:
+        """Returns the unfinished match this player was placed in and has since disconnected from, if any"""
+        for arena_id in self.arena_ids:
+            match = self.matches.get(arena_id)
+            if (
+                match is not None
+                and not match.finished
+                and match.player_secrets.get(name) == secret
+                and match.player_connected.get(name) is False
+            ):
+                return match
+        return None
+
+    async def place(self, name: str, secret: str) -> Match:
+        """Waits until the player has been added to a match, and returns it"""
+        player = WaitingPlayer(name, secret, asyncio.get_running_loop().create_future())
+        self.waiting.append(player)
+        try:
+            self.pack(time.monotonic())
+            return await player.placed
+        except asyncio.CancelledError:
+            # The player may have left just as they were placed, so don't leave a robot behind that nobody controls
+            if player.placed.done() and not player.placed.cancelled():
+                match = player.placed.result()
+                if match.started:
+                    match.player_connected[name] = False
+                else:
+                    match.remove_robot(name)
+            raise
+        finally:
+            if player in self.waiting:
+                self.waiting.remove(player)
+
+    def _place(self, player: WaitingPlayer, match: Match) -> None:
+        match.add_robot(player.name, player.secret)
+        self.waiting.remove(player)
+        player.placed.set_result(match)
+
+    def _fill(self, match: Match) -> None:
+        for player in self.waiting[:]:
+            if match.has_room_for(player.name):
+                self._place(player, match)
+
+    def _free_arena_id(self) -> Optional[int]:
+        """Returns an unused arena ID, counting down from the highest so that low IDs are left for choosing by hand"""
+        return next((arena_id for arena_id in range(MAX_ARENA_ID, 0, -1) if arena_id not in self.matches), None)
+
+    def pack(self, now: float) -> None:
+        """Places as many waiting players as possible"""
+        self.arena_ids = {arena_id for arena_id in self.arena_ids if arena_id in self.matches}
+        open_matches = [self.matches[arena_id] for arena_id in self.arena_ids if not self.matches[arena_id].started]
+        for match in open_matches:
+            # Players who leave before their match starts are placed afresh if they come back, so make room for others.
+            # Once the countdown to the start has begun, the players are left alone.
+            if match.starting:
+                continue
+            for name, connected in list(match.player_connected.items()):
+                if not connected:
+                    match.remove_robot(name)
+        for match in sorted(open_matches, key=lambda m: len(m.arena.robots), reverse=True):
+            self._fill(match)
+        while self.waiting and (
+            len(self.waiting) >= MAX_MATCH_PLAYERS or now - self.waiting[0].since >= MATCHMAKING_MAX_WAIT
+        ):
+            arena_id = self._free_arena_id()
+            if arena_id is None:
+                print("No free arenas for matchmaking")
+                return
+            print(f"Matchmaking {len(self.waiting)} waiting players into arena {arena_id}")
+            self.arena_ids.add(arena_id)
+            self._fill(get_or_create_match(self.matches, arena_id, recycle=False, db=self.db))
+
+
+async def matchmaking_task(matchmaker: Matchmaker) -> None:
+    """Periodically places players who have waited too long for an arena to fill up"""
+    while True:
+        await asyncio.sleep(MATCHMAKING_INTERVAL)
+        matchmaker.pack(time.monotonic())
+
+
+def checkpoint_matches(matches: Dict[int, Match], db: Connection) -> None:
+    """Checkpoints every unfinished match which has players. The demo match is skipped, as its players are
+    recreated along with it."""
+    now = datetime.now(tz=timezone.utc)
+    for match in matches.values():
+        if match.arena_id == 0 or match.finished or not match.arena.robots:
+            continue
+        store_checkpoint(db, match.arena_id, now, match.checkpoint())
+
+
+async def checkpoint_task(matches: Dict[int, Match], db: Connection) -> None:
+    """Periodically checkpoints running matches"""
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        try:
+            checkpoint_matches(matches, db)
+        except Exception as e:
+            print(f"Checkpoint exception: {e!r}")
+
+
+def restore_matches(matches: Dict[int, Match], db: Connection) -> None:
+    """Recreates matches from their checkpoints. Matches which had already started resume straight away, after
+    giving their players a chance to reconnect."""
+    for arena_id, data in get_checkpoints(db):
+        try:
+            match = Match.from_checkpoint(data, db)
+        except Exception as e:
+            print(f"Could not restore match {arena_id}: {e!r}")
+            delete_checkpoint(db, arena_id)
+            continue
+        matches[arena_id] = match
+        if match.started:
+            match.activate()
+        print(f"Restored match {arena_id} with {len(match.arena.robots)} players")
+
+
 async def runner_task(match: Match) -> None:
     """Runs a single match, returning when there is a clear winner or there are no turns remaining"""
     try:
-        print(f"Waiting for at least {match.min_num_players} players")
-        while len(match.arena.robots) < match.min_num_players:
-            await asyncio.sleep(1)
-        print(f"{len(match.arena.robots)} have joined, will start in {match.wait_time} seconds")
-        await asyncio.sleep(match.wait_time)
-        print(f"Starting battle with: {', '.join(r.name for r in match.arena.robots)}")
-        match.started = True
+        if match.started:
+            # Restored from a checkpoint
+            print(f"Resuming battle in {match.wait_time} seconds")
+            await asyncio.sleep(match.wait_time)
+        else:
+            while True:
+                print(f"Waiting for at least {match.min_num_players} players")
+                while len(match.arena.robots) < match.min_num_players:
+                    await match.players_changed.wait()
+                    match.players_changed.clear()
+                match.starting = True
+                print(f"{len(match.arena.robots)} have joined, will start in {match.wait_time} seconds")
+                await asyncio.sleep(match.wait_time)
+                # Players may have been removed during the countdown
+                if len(match.arena.robots) >= match.min_num_players:
+                    break
+                match.starting = False
+            print(f"Starting battle with: {', '.join(r.name for r in match.arena.robots)}")
+            match.started = True
+        match.started_at = time.monotonic()
         standing_orders = {r.name: RobotCommand(RobotCommandType.IDLE, 0) for r in match.arena.robots}
         while not match.arena.get_winner() and match.arena.remaining > 0:
             match.arena.remaining -= 1
@@ -114,7 +534,7 @@ async def runner_task(match: Match) -> None:
                     r.cmd_q_len = len(match.command_queues[r.name])
                 match.event.set()
                 match.event.clear()
-                await asyncio.sleep(GameParameters.COMMAND_RATE / GameParameters.FPS)
+                await match.wait_for_commands()
                 for r in match.arena.robots:
                     q = match.command_queues.get(r.name)
                     if q:
@@ -141,112 +561,167 @@ async def runner_task(match: Match) -> None:
         match.arena.winner = winner.name
         match.arena_state_delay_line.append(deepcopy(match.arena))
         match.finished = True
+        match.touch()
         match.event.set()
         match.event.clear()
         print(f"{winner.name} is the winner!")
         if match.stats_db:
+            delete_checkpoint(match.stats_db, match.arena_id)
             print("Storing match stats ...", end="")
             match_id = store_match(match.stats_db, match.arena_id, datetime.now(tz=timezone.utc), winner.name)
             print(f"match_id={match_id}...", end="")
             for name, cmd_stats in match.stats.items():
                 for cmd, stat in cmd_stats.items():
                     store_match_cmd_stat(match.stats_db, match_id, name, cmd, stat)
+            for name, latency in match.latency.items():
+                store_match_latency_stat(
+                    match.stats_db, match_id, name, latency.commands, latency.late_commands, latency.percentiles()
+                )
             print("done!")
     except Exception as e:
         print(f"Runner exception: {e!r}")
 
 
-async def server_task(bind_addr: str = "127.0.0.1") -> None:
+async def server_task(
+    bind_addr: str = "127.0.0.1", watch_compression: bool = WATCH_COMPRESSION, admin_token: Optional[str] = None
+) -> None:
     app = web.Application()
-    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(TEMPLATE_PATH))
 
     app["matches"] = {}
+    app["admin_token"] = admin_token
     app["match_db"] = create_connection()
+    app["watch_compression"] = watch_compression
+    app["spectators"] = set()
+    app["allocation_tracer"] = AllocationTracer()
+    app["matchmaker"] = Matchmaker(app["matches"], app["match_db"])
+    restore_matches(app["matches"], app["match_db"])
 
-    app.router.add_get("/", index_handler)
-    app.router.add_get("/game/{arena_id}", index_handler)
     app.router.add_get("/api/watch/{arena_id}", watch_handler)
     app.router.add_get("/api/play/{arena_id}", play_handler)
     app.router.add_get("/api/leaderboard/{arena_id}", leaderboard_handler)
-    app.router.add_static("/", STATIC_PATH, name="static", append_version=True)
+    app.router.add_get("/api/matches", match_history_handler)
+    app.router.add_get("/api/stats/commands", command_stats_handler)
+    app.router.add_get("/api/export/{table}", export_handler)
+    app.router.add_get("/api/admin/spectators", spectators_handler)
+    app.router.add_get("/api/admin/memory", memory_handler)
+    app.router.add_post("/api/admin/tracemalloc/{action}", tracemalloc_handler)
+    add_site_routes(app)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, bind_addr, 8000)
     await site.start()
     print(f"Serving on http://{bind_addr}:8000")
+    eviction = asyncio.create_task(evictor_task(app["matches"]))
+    checkpointing = asyncio.create_task(checkpoint_task(app["matches"], app["match_db"]))
+    matchmaking = asyncio.create_task(matchmaking_task(app["matchmaker"]))
     try:
         await asyncio.Future()
     finally:
+        eviction.cancel()
+        checkpointing.cancel()
+        matchmaking.cancel()
+        checkpoint_matches(app["matches"], app["match_db"])
         await runner.cleanup()
 
 
-@aiohttp_jinja2.template("index.html.j2")
-async def index_handler(request):
-    return {}
-
-
 async def watch_handler(request):
     """Sends arena updates to the client for rendering. Since this includes all x,y positions of each robot,
-    a delay-line is used to minimize any benefit of cheating."""
-    ws = web.WebSocketResponse()
+    a delay-line is used to minimize any benefit of cheating. Spectators may pass a lower frame `rate`, in which case
+    only every few frames are sent."""
+    try:
+        rate = int(request.query.get("rate", GameParameters.FPS))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    rate = min(GameParameters.FPS, max(MIN_STREAM_RATE, rate))
+    stride = round(GameParameters.FPS / rate)
+
+    ws = web.WebSocketResponse(compress=request.app["watch_compression"])
     await ws.prepare(request)
 
     arena_id = int(request.match_info["arena_id"])
     print(f"New request for arena {arena_id}")
+    # Spectators of large arenas subscribe to a viewport, and are only sent what is in or near it
+    viewport: Optional[Viewport] = None
+    queue = SpectatorQueue(arena_id)
 
     async def send_updates():
         placeholder_arena = Arena()
         try:
             while True:
-                match = get_or_create_match(
-                    request.app["matches"], arena_id, recycle=arena_id == 0, db=request.app["match_db"]
-                )
+                # Only the demo arena is created by spectators - other arenas are created when a player joins
+                if arena_id == 0:
+                    match = get_or_create_match(
+                        request.app["matches"], arena_id, recycle=True, db=request.app["match_db"]
+                    )
+                else:
+                    match = request.app["matches"].get(arena_id)
+                if match is None:
+                    queue.put(state_as_json(placeholder_arena))
+                    await asyncio.sleep(1)
+                    continue
                 delay_line = match.arena_state_delay_line
                 # Wait until enough time has passed before we start sending results
-                while len(delay_line) < ARENA_STATE_DELAY_LINE_LEN:
+                while (
+                    len(delay_line) < ARENA_STATE_DELAY_LINE_LEN
+                    and not match.finished
+                    and request.app["matches"].get(arena_id) is match
+                ):
                     msg = state_as_json(placeholder_arena)
-                    await ws.send_str(msg)
+                    queue.put(msg)
                     await asyncio.sleep(1)
-                # Start playing from near the end
-                if match.finished:
-                    idx = len(delay_line) - 1
+                # Start over if the match was evicted while we waited
+                if request.app["matches"].get(arena_id) is not match or not delay_line:
+                    continue
+                # Start playing from near the end, or wherever the broadcast of a lockstep match is up to
+                if match.finished and not match.lockstep:
+                    idx = max(0, len(delay_line) - 1)
                 else:
-                    idx = max(0, len(delay_line) - ARENA_STATE_DELAY_LINE_LEN)
+                    idx = max(0, match.playback_position())
                 # Return results until we reach the end and the actual game is finished
                 while not match.finished or idx < len(delay_line):
-                    # Ensure we don't go over the end
+                    # Ensure we don't go over the end, or fall behind the oldest frame kept
                     if idx >= len(delay_line):
                         idx = len(delay_line) - 1
+                    idx = max(idx, delay_line.first)
                     # Ensure we don't fall behind either
-                    lag = len(delay_line) - ARENA_STATE_DELAY_LINE_LEN - idx
-                    if lag > 0:
-                        fps_mult = 1.1
-                    elif lag < 0:
-                        fps_mult = 0.99
-                    else:
-                        fps_mult = 1
+                    fps_mult = playback_rate(match.playback_position() - idx)
 
                     # Get the arena state to send
                     arena = delay_line[idx]
-                    idx += 1
-                    # Send it
-                    msg = state_as_json(arena)
-                    await asyncio.gather(ws.send_str(msg), asyncio.sleep(1 / GameParameters.FPS / fps_mult))
+                    prior = delay_line[idx - 1] if idx > 0 else None
+                    # Skipping frames must still land on the last one, which shows the winner
+                    idx = min(idx + stride, len(delay_line) - 1) if idx < len(delay_line) - 1 else idx + 1
+                    # Queue it for sending - this doesn't wait for the spectator, so pacing isn't affected by them
+                    msg = state_as_json(arena, viewport, stride, prior)
+                    queue.put(msg)
+                    await asyncio.sleep(stride / GameParameters.FPS / fps_mult)
                 # Match is finished and we've replayed everything, chill for a bit - replay the final
                 # frame until a new match is available
                 await asyncio.sleep(1)
+        except SpectatorStalled:
+            await queue.disconnect(request, ws)
         except Exception as e:
             print(f"Exception: {e!r}")
         finally:
             print("Exiting sender")
 
     send_task = asyncio.create_task(send_updates())
+    write_task = asyncio.create_task(queue.run(ws))
+    request.app["spectators"].add(queue)
     try:
         async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.ERROR:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    viewport = Viewport.from_dict(msg.json()["viewport"])
+                except (json.decoder.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                    print(f"Bad viewport: {e!r}")
+            elif msg.type == aiohttp.WSMsgType.ERROR:
                 print("ws connection closed with exception %s" % ws.exception())
     finally:
         send_task.cancel()
+        write_task.cancel()
+        request.app["spectators"].discard(queue)
+        print(f"Spectator sent {queue.sent} frames, dropped {queue.dropped}")
 
     print("websocket connection closed")
 
@@ -255,20 +730,31 @@ async def watch_handler(request):
 
 async def play_handler(request):
     """Sends robot updates to the client and gets resulting commands, adding them to a command queue for the
-    given robot."""
+    given robot. Players connecting to /api/play/auto are placed in an arena by the matchmaker."""
     ws = web.WebSocketResponse()
     await ws.prepare(request)
 
-    arena_id = int(request.match_info["arena_id"])
-    match = get_or_create_match(request.app["matches"], arena_id, recycle=True, db=request.app["match_db"])
+    match: Optional[Match] = None
+    if request.match_info["arena_id"] != "auto":
+        arena_id = int(request.match_info["arena_id"])
+        large = request.query.get("large") == "1"
+        lockstep = request.query.get("lockstep") == "1"
+        match = get_or_create_match(
+            request.app["matches"], arena_id, recycle=True, db=request.app["match_db"], large=large, lockstep=lockstep
+        )
 
     async def send_updates():
+        windows = 0
         try:
             while True:
                 await match.event.wait()
                 r = match.arena.get_robot(robot_name)
                 msg = json.dumps(asdict(r), separators=(",", ":"))
+                match.latency[robot_name].state_sent(time.monotonic(), r.cmd_q_len or 0)
                 await ws.send_str(msg)
+                windows += 1
+                if echo_latency and windows % LATENCY_ECHO_INTERVAL == 0:
+                    await ws.send_json({"echo": f"{robot_name} latency: {match.latency[robot_name].summary()}"})
                 if match.arena.winner is not None:
                     await ws.send_json({"echo": f"{match.arena.winner} is the winner!"})
                     break
@@ -291,12 +777,27 @@ async def play_handler(request):
         hello_msg = await ws.receive_json()
         robot_name = hello_msg["name"]
         robot_secret = hello_msg["secret"]
+        echo_latency = bool(hello_msg.get("latency"))
         if not isinstance(robot_name, str):
             return
         if not isinstance(robot_secret, str):
             return
 
-        if robot_secret == match.player_secrets.get(robot_name) and not match.player_connected.get(robot_name):
+        if match is None:
+            match = request.app["matchmaker"].rejoin(robot_name, robot_secret)
+            if match is not None:
+                await ws.send_json(
+                    {"echo": f"Welcome back, {robot_name}, to game {match.arena_id}", "arena_id": match.arena_id}
+                )
+            else:
+                await ws.send_json({"echo": f"Waiting for a game, {robot_name}"})
+                match = await wait_for_placement(request.app["matchmaker"], ws, robot_name, robot_secret)
+                if match is None:
+                    return ws
+                await ws.send_json(
+                    {"echo": f"Welcome, {robot_name}, to game {match.arena_id}", "arena_id": match.arena_id}
+                )
+        elif robot_secret == match.player_secrets.get(robot_name) and not match.player_connected.get(robot_name):
             await ws.send_json({"echo": f"Welcome back, {robot_name}"})
         else:
             if match.started and not match.allow_late_entrants:
@@ -307,26 +808,19 @@ async def play_handler(request):
             if any(r.name == robot_name for r in match.arena.robots):
                 await ws.send_json({"echo": f"Sorry, {robot_name} is already in the game"})
                 return
-            # Limit the number of players to MAX_MATCH_PLAYERS
+            # Limit the number of players to the match's player cap
             num_alive = len([r for r in match.arena.robots if r.live()])
-            if num_alive >= MAX_MATCH_PLAYERS:
+            if num_alive >= match.max_players:
                 await ws.send_json({"echo": f"Sorry {robot_name}, this game is full"})
                 return
-            # Drop any dead players making room for more
-            if len(match.arena.robots) != num_alive:
-                for r in match.arena.robots[:]:
-                    if not r.live():
-                        print(f"Dropping robot {r.name}")
-                        match.arena.robots.remove(r)
-                        match.command_queues.pop(r.name, None)
             # Finally we can add this new robot
             await ws.send_json({"echo": f"Welcome, {robot_name}"})
-            print(f"Adding robot {robot_name}")
-            match.arena.robots.append(Robot(robot_name))
-            match.command_queues[robot_name] = []
-            match.player_secrets[robot_name] = robot_secret
+            match.add_robot(robot_name, robot_secret)
         # Start sending state updates to the player
         match.player_connected[robot_name] = True
+        match.touch()
+        match.players_changed.set()
+        match.activate()
         send_task = asyncio.create_task(send_updates())
         # Start receiving commands from the player, adding them to the command queue
         async for msg in ws:
@@ -337,12 +831,15 @@ async def play_handler(request):
                         continue
                     if isinstance(cmds, dict):
                         cmds = [cmds]
+                    if cmds:
+                        match.latency[robot_name].command_received(time.monotonic())
                     for cmd in cmds[: match.arena.remaining]:
                         command = RobotCommand(
                             command_type=RobotCommandType(cmd.get("command_type")),
                             parameter=float(cmd.get("parameter")),
                         )
                         match.command_queues[robot_name].append(command)
+                    match.commands_queued.set()
                 except KeyError:
                     print("Robot dropped")
                     break
@@ -354,8 +851,9 @@ async def play_handler(request):
                 print("ws connection closed with exception %s" % ws.exception())
                 break
     finally:
-        if robot_name is not None:
+        if robot_name is not None and match is not None:
             match.player_connected[robot_name] = False
+            match.touch()
         if send_task is not None:
             send_task.cancel()
             await asyncio.gather(send_task, return_exceptions=True)
@@ -366,6 +864,22 @@ async def play_handler(request):
     return ws
 
 
+async def wait_for_placement(
+    matchmaker: Matchmaker, ws: web.WebSocketResponse, robot_name: str, robot_secret: str
+) -> Optional[Match]:
+    """Waits for the matchmaker to place the player, returning None if the player disconnects first"""
+    placement = asyncio.create_task(matchmaker.place(robot_name, robot_secret))
+    disconnect = asyncio.create_task(ws.receive())
+    try:
+        # Nothing is expected from the player until it is sent its state, so any message means it has gone
+        await asyncio.wait({placement, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        placement.cancel()
+    (result,) = await asyncio.gather(placement, return_exceptions=True)
+    return result if isinstance(result, Match) else None
+
+
 def leaderboard_handler(request):
     arena_id = int(request.match_info["arena_id"])
     if arena_id < 0 or arena_id > MAX_ARENA_ID:
@@ -374,13 +888,151 @@ def leaderboard_handler(request):
     return web.json_response(data)
 
 
+def check_admin(request) -> None:
+    """Rejects admin requests without the admin token. Without a token set, only local requests are allowed."""
+    admin_token = request.app["admin_token"]
+    if admin_token is None:
+        if request.remote not in LOCAL_ADDRESSES:
+            raise web.HTTPForbidden(text="Admin APIs are only available locally unless an admin token is set")
+    elif not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {admin_token}"):
+        raise web.HTTPUnauthorized(text="Admin APIs need an Authorization: Bearer <admin token> header")
+
+
+def spectators_handler(request):
+    """Returns the send queue state of every connected spectator, including how many frames were dropped"""
+    check_admin(request)
+    return web.json_response([queue.stats() for queue in request.app["spectators"]])
+
+
+async def memory_handler(request):
+    """Returns the approximate memory used by each match, largest first. While allocation tracing is on, the
+    allocation sites that have grown most since tracing started are included."""
+    check_admin(request)
+    matches = [match.memory_usage() for match in request.app["matches"].values()]
+    matches.sort(key=lambda m: sum(m["approx_bytes"].values()), reverse=True)
+    # Snapshots of a large heap take seconds, which would stall every match if taken on the event loop
+    top_growth = await asyncio.get_running_loop().run_in_executor(None, request.app["allocation_tracer"].top_growth)
+    return web.json_response(
+        {
+            "max_rss_kb": max_rss_kb(),
+            "matches": matches,
+            "delay_line_frames": sum(m["delay_line_frames"] for m in matches),
+            "top_allocation_growth": top_growth,
+        }
+    )
+
+
+async def tracemalloc_handler(request):
+    """Starts allocation tracing and takes a baseline snapshot, or stops it"""
+    check_admin(request)
+    tracer = request.app["allocation_tracer"]
+    action = request.match_info["action"]
+    if action == "start":
+        await asyncio.get_running_loop().run_in_executor(None, tracer.start)
+    elif action == "stop":
+        tracer.stop()
+    else:
+        raise web.HTTPNotFound
+    return web.json_response({"tracing": tracemalloc.is_tracing()})
+
+
+def parse_time(value: str) -> datetime:
+    """Parses an ISO 8601 time, assuming UTC if no timezone is given"""
+    t = datetime.fromisoformat(value)
+    if t.tzinfo is None:
+        return t.replace(tzinfo=timezone.utc)
+    return t.astimezone(timezone.utc)
+
+
+def parse_match_filter(request) -> Dict[str, Any]:
+    """Parses the arena_id, robot, since and until query parameters common to the match history APIs"""
+    query = request.query
+    try:
+        return {
+            "arena_id": int(query["arena_id"]) if "arena_id" in query else None,
+            "robot_name": query.get("robot"),
+            "since": parse_time(query["since"]) if "since" in query else None,
+            "until": parse_time(query["until"]) if "until" in query else None,
+        }
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+
+def match_history_handler(request):
+    """Returns a page of matches, newest first. The `next_before` value is passed as `before` to get the next page."""
+    filters = parse_match_filter(request)
+    try:
+        before = int(request.query["before"]) if "before" in request.query else None
+        limit = min(MAX_HISTORY_PAGE_SIZE, max(1, int(request.query.get("limit", 100))))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    rows = get_match_history(request.app["match_db"], **filters, before=before, limit=limit)
+    matches = [dict(zip(EXPORT_COLUMNS["match"], row)) for row in rows]
+    next_before = matches[-1]["match_id"] if len(matches) == limit else None
+    return web.json_response({"matches": matches, "next_before": next_before})
+
+
+def command_stats_handler(request):
+    """Returns the number of matches and total commands issued, per robot and command"""
+    filters = parse_match_filter(request)
+    rows = get_command_totals(request.app["match_db"], **filters)
+    return web.json_response([dict(zip(("robot_name", "command", "matches", "total"), row)) for row in rows])
+
+
+async def export_handler(request):
+    """Streams all rows of the match or match_stat table as NDJSON or CSV, without loading them all into memory"""
+    table = request.match_info["table"]
+    if table not in EXPORT_COLUMNS:
+        raise web.HTTPNotFound
+    export_format = request.query.get("format", "ndjson")
+    if export_format not in ("ndjson", "csv"):
+        raise web.HTTPBadRequest(text=f"Unknown format {export_format}")
+    filters = parse_match_filter(request)
+    columns = EXPORT_COLUMNS[table]
+
+    response = web.StreamResponse()
+    response.content_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    response.headers["Content-Disposition"] = f'attachment; filename="{table}.{export_format}"'
+    response.enable_compression()
+    await response.prepare(request)
+    if export_format == "csv":
+        await response.write((",".join(columns) + "\r\n").encode())
+    for rows in iter_export(request.app["match_db"], table, **filters):
+        if export_format == "csv":
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            data = buf.getvalue()
+        else:
+            data = "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+        # Writing yields to the event loop between chunks, and applies backpressure from slow clients
+        await response.write(data.encode())
+    await response.write_eof()
+    return response
+
+
 async def amain():
     parser = argparse.ArgumentParser()
     parser.add_argument("--addr", default="127.0.0.1", help="Battle server bind address (default: 127.0.0.1)")
+    parser.add_argument(
+        "--no-watch-compression",
+        dest="watch_compression",
+        action="store_false",
+        help="Disable per-message deflate compression of the spectator stream",
+    )
+    parser.add_argument(
+        "--admin-token",
+        help="Bearer token required by the admin APIs (default: admin APIs are only available locally)",
+    )
     args = parser.parse_args()
+    server = asyncio.create_task(server_task(args.addr, args.watch_compression, args.admin_token))
+    # Deployments stop the server with SIGTERM, which should checkpoint running matches just like Ctrl-C does
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.cancel)
+    except NotImplementedError:
+        pass
     try:
-        await server_task(args.addr)
-    except KeyboardInterrupt:
+        await server
+    except (KeyboardInterrupt, asyncio.CancelledError):
         return
 
 
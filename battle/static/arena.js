@@ -1,5 +1,15 @@
 const SCALE = 1;
+const NUM_STARS = 2000;
+// Stars move towards the viewer at this many units per second
+const STAR_SPEED = 0.2;
+// The star field is redrawn to its own offscreen canvas at most this often (ms)
+const STAR_INTERVAL = 100;
+// The scene is redrawn at most this often (ms), and only when there is something new to show
+const MIN_DRAW_INTERVAL = 1000 / 30;
 var backgroundImage = null;
+var backgroundCanvas = null;
+var starsCanvas = null;
+var starsDrawnAt = null;
 var explosionImage = null;
 var laserImage = null;
 var hullImage = null;
@@ -7,10 +17,17 @@ var turretImage = null;
 var galaxyImage = null;
 var exhaustImages = null;
 var arena = null;
-var lastUpdate = null;
+var arenaReceivedAt = null;
+var lastDraw = null;
+var dirty = false;
 var webSocket = null;
-var stars = [];
+var decoder = null;
+var stars = null;
 var leaderboardUpdated = false;
+// The region of the arena being watched - only matters for arenas larger than the canvas
+var viewport = {x: 0, y: 0, width: 1000, height: 1000};
+var viewportSent = false;
+var dragStart = null;
 
 function getArenaId() {
     var loc = window.location;
@@ -62,15 +79,19 @@ function openSocket() {
 
     document.title = `Battlefield Arena ${arenaId}`
 
-    webSocket = new WebSocket(`${scheme}//${loc.host}/api/watch/${arenaId}`);
+    // A lower frame rate, e.g. /game/0?rate=5, can be requested to save bandwidth
+    const rate = new URLSearchParams(loc.search).get("rate");
+    const query = rate ? `?rate=${encodeURIComponent(rate)}` : "";
+    webSocket = new WebSocket(`${scheme}//${loc.host}/api/watch/${arenaId}${query}`);
 
     webSocket.onopen = function (event) {
         console.log("open websocket")
+        viewportSent = false;
     };
 
+    // Decoding happens in the worker - the decoded state is picked up by the next animation frame
     webSocket.onmessage = function (event) {
-        arena = transpose(JSON.parse(event.data));
-        window.requestAnimationFrame(draw);
+        decoder.postMessage(event.data);
     };
 
     webSocket.onclose = function (event) {
@@ -78,20 +99,61 @@ function openSocket() {
     };
 }
 
-const transpose = function (obj) {
-    if (_.isNumber(obj) || _.isString(obj) || _.isNull(obj) || _.isBoolean(obj)) {
-        return obj;
-    }
-    if (_.isArray(obj)) {
-        return _.map(obj, transpose);
+function openDecoder(url) {
+    decoder = new Worker(url);
+    decoder.onmessage = function (event) {
+        arena = event.data;
+        arenaReceivedAt = performance.now();
+        dirty = true;
+        if (!viewportSent && isLargeArena()) {
+            sendViewport();
+            viewportSent = true;
+        }
+    };
+}
+
+function isLargeArena() {
+    return arena.width > viewport.width || arena.height > viewport.height;
+}
+
+const sendViewport = _.throttle(function () {
+    if (webSocket && webSocket.readyState === WebSocket.OPEN) {
+        webSocket.send(JSON.stringify({viewport: viewport}));
     }
-    if (obj._t) {
-        delete obj._t;
-        const keys = _.keys(obj);
-        const values = _.values(obj).map(transpose);
-        return _.zip(...values).map(v => _.zipObject(keys, v));
+}, 100);
+
+function panViewport(dx, dy) {
+    if (!arena || !isLargeArena()) {
+        return;
     }
-    return _.mapValues(obj, transpose);
+    viewport.x = _.clamp(viewport.x + dx, 0, Math.max(0, arena.width - viewport.width));
+    viewport.y = _.clamp(viewport.y + dy, 0, Math.max(0, arena.height - viewport.height));
+    dirty = true;
+    sendViewport();
+}
+
+function setupPanning(canvas) {
+    canvas.addEventListener("mousedown", event => {
+        dragStart = {x: event.clientX, y: event.clientY};
+    });
+    window.addEventListener("mouseup", event => {
+        dragStart = null;
+    });
+    window.addEventListener("mousemove", event => {
+        if (dragStart) {
+            const scale = viewport.width / canvas.clientWidth;
+            panViewport((dragStart.x - event.clientX) * scale, (dragStart.y - event.clientY) * scale);
+            dragStart = {x: event.clientX, y: event.clientY};
+        }
+    });
+    window.addEventListener("keydown", event => {
+        const step = viewport.width / 4;
+        const moves = {ArrowLeft: [-step, 0], ArrowRight: [step, 0], ArrowUp: [0, -step], ArrowDown: [0, step]};
+        if (event.key in moves) {
+            panViewport(...moves[event.key]);
+            event.preventDefault();
+        }
+    });
 }
 
 window.onload = function () {
@@ -111,34 +173,99 @@ window.onload = function () {
         document.getElementById("exhaust0"),
         document.getElementById("exhaust1")
     ];
-    openSocket();
-    for (var i=0; i<2000; i++) {
-        stars.push(randomStar());
+    const canvas = document.getElementById("canvas");
+    setupPanning(canvas);
+    backgroundCanvas = renderBackground();
+    starsCanvas = document.createElement("canvas");
+    starsCanvas.width = 1000;
+    starsCanvas.height = 1000;
+    stars = {x: new Float32Array(NUM_STARS), y: new Float32Array(NUM_STARS), z: new Float32Array(NUM_STARS)};
+    for (let i = 0; i < NUM_STARS; i++) {
+        resetStar(i, 10 * Math.random());
     }
+    openDecoder(canvas.dataset.decoder);
+    openSocket();
     updateLeaderboard();
+    window.requestAnimationFrame(renderLoop);
 }
 
-function randomStar() {
-    return {x: 4*Math.random() - 2, y: 4*Math.random() - 2, z: 10*Math.random()};
+// The background never changes, so it is rendered once to an offscreen canvas
+function renderBackground() {
+    const offscreen = document.createElement("canvas");
+    offscreen.width = 1000;
+    offscreen.height = 1000;
+    const ctx = offscreen.getContext("2d");
+    ctx.fillStyle = 'black';
+    ctx.fillRect(0, 0, 1000, 1000);
+    if (backgroundImage.complete && backgroundImage.naturalWidth > 0) {
+        ctx.globalAlpha = 0.3;
+        ctx.drawImage(backgroundImage, 0, 0, backgroundImage.width / 2, backgroundImage.height / 2, 0, 0, 1000, 1000);
+    }
+    return offscreen;
 }
 
-function draw(timestamp) {
-    if (timestamp == lastUpdate) {
+function resetStar(i, z) {
+    stars.x[i] = 4*Math.random() - 2;
+    stars.y[i] = 4*Math.random() - 2;
+    stars.z[i] = z;
+}
+
+// Moves the stars on and draws them to the offscreen star canvas, which is then drawn in one go on each frame
+function renderStars(elapsed) {
+    const dz = STAR_SPEED * elapsed / 1000;
+    const ctx = starsCanvas.getContext("2d");
+    ctx.clearRect(0, 0, starsCanvas.width, starsCanvas.height);
+    ctx.save();
+    ctx.fillStyle = `white`;
+    for (let i = 0; i < NUM_STARS; i++) {
+        const z = stars.z[i];
+        const size = 2 - z/10;
+        ctx.globalAlpha = (10-z) / 10;
+        ctx.fillRect(500 + 1000 * stars.x[i] / z, 500 + 1000 * stars.y[i] / z, size, size);
+        stars.z[i] -= dz;
+        if (stars.z[i] <= 0) {
+            resetStar(i, 10);
+        }
+    }
+    ctx.restore();
+}
+
+// Draws the most recently decoded state on animation frames, independently of when messages arrive. Frames are
+// skipped unless a new state has arrived, the view has moved, the state is being extrapolated, or the stars are due
+// to move on - so the star field keeps moving on screens which rarely change, like waiting for players.
+function renderLoop(timestamp) {
+    window.requestAnimationFrame(renderLoop);
+    if (!arena || lastDraw !== null && timestamp - lastDraw < MIN_DRAW_INTERVAL) {
+        return;
+    }
+    const extrapolating = arena.stride && framesAhead(timestamp) < arena.stride;
+    const starsDue = starsDrawnAt === null || timestamp - starsDrawnAt >= STAR_INTERVAL;
+    if (!dirty && !extrapolating && !starsDue) {
         return;
     }
-    lastUpdate = timestamp;
+    dirty = false;
+    lastDraw = timestamp;
+    draw(timestamp);
+}
+
+// When only every few frames are sent, returns how many frames to extrapolate the current state by
+function framesAhead(timestamp) {
+    if (!arena.stride || arenaReceivedAt === null) {
+        return 0;
+    }
+    return _.clamp((timestamp - arenaReceivedAt) * arena.fps / 1000, 0, arena.stride);
+}
 
+// Advances an animation by some frames. Animations end after their last frame, and are NaN when not running.
+function advanceAnimation(progress, steps, numFrames) {
+    const p = progress + steps;
+    return p < numFrames ? p : NaN;
+}
+
+function draw(timestamp) {
     const ctx = document.getElementById('canvas').getContext('2d');
 
-    ctx.save();
-    ctx.clearRect(0, 0, 1000, 1000);
-    ctx.strokeStyle = 'black';
-    ctx.fillStyle = 'black';
-    ctx.fillRect(0, 0, 1000, 1000);
-    ctx.stroke();
-    ctx.globalAlpha = 0.3;
-    ctx.drawImage(backgroundImage, 0, 0, backgroundImage.width / 2, backgroundImage.height / 2, 0, 0, 1000, 1000);
-    ctx.restore();
+    ctx.drawImage(backgroundCanvas, 0, 0);
 
     ctx.save();
     ctx.translate(500, 500);
@@ -152,93 +279,114 @@ function draw(timestamp) {
         leaderboardUpdated = false;
     }
 
-    ctx.fillStyle = `white`;
-    stars.forEach(star => {
-        const size = (2 - star.z/10)/1000;
-        ctx.save();
-        ctx.globalAlpha = (10-star.z) / 10;
-        ctx.scale(1000, 1000);
-        ctx.fillRect(star.x / star.z, star.y / star.z, size, size);
-        ctx.restore();
-        star.z -= 0.01;
-    });
-    stars = stars.map((s) => s.z > 0 ? s : randomStar())
     ctx.restore();
+    if (starsDrawnAt === null || timestamp - starsDrawnAt >= STAR_INTERVAL) {
+        renderStars(starsDrawnAt === null ? 0 : Math.min(1000, timestamp - starsDrawnAt));
+        starsDrawnAt = timestamp;
+    }
+    ctx.drawImage(starsCanvas, 0, 0);
+
+    // Everything else is drawn in arena co-ordinates, relative to the viewport
+    ctx.save();
+    ctx.translate(-viewport.x, -viewport.y);
 
-    arena.robots.forEach(robot => {
+    // Robots and missiles are decoded into columns, indexed by entity. Positions, angles and animations are
+    // extrapolated from the last state received, if frames are being skipped.
+    const ahead = framesAhead(timestamp);
+    const steps = Math.floor(ahead);
+    const robots = arena.robots;
+    for (let i = 0; i < robots.length; i++) {
         const img = hullImage;
-        const dx = robot.position.x;
-        const dy = robot.position.y;
+        const radius = robots.radius[i];
+        const velocityAngle = robots.velocity_angle[i] / 180 * Math.PI;
+        const dx = _.clamp(robots.position.x[i] + ahead * robots.velocity[i] * Math.cos(velocityAngle), radius, arena.width - radius);
+        const dy = _.clamp(robots.position.y[i] + ahead * robots.velocity[i] * Math.sin(velocityAngle), radius, arena.height - radius);
+        const hullAngle = robots.hull_angle[i] + (ahead ? ahead * robots.hull_rate[i] : 0);
+        const turretAngle = robots.turret_angle[i] + (ahead ? ahead * robots.turret_rate[i] : 0);
+        const health = robots.health[i];
 
         ctx.save();
         ctx.translate(dx, dy);
         ctx.scale(SCALE, SCALE);
 
         // Dead robots become ghosts
-        if (robot.health <= 0) {
+        if (health <= 0) {
             ctx.globalAlpha = 0.5;
         }
 
         // Labels
-        const labely = hullImage.height * (dy < 500 ? 0.75 : -0.75);
+        const labely = hullImage.height * (dy - viewport.y < viewport.height / 2 ? 0.75 : -0.75);
         ctx.fillStyle = 'red';
         ctx.font = '16px monospace';
         ctx.textAlign = 'center';
-        ctx.fillText(`${robot.name} (${robot.health}%)`, 0, labely);
+        ctx.fillText(`${robots.name[i]} (${health}%)`, 0, labely);
 
         // Draw the hull
-        ctx.rotate(Math.PI / 2 + robot.hull_angle / 180 * Math.PI);
+        ctx.rotate(Math.PI / 2 + hullAngle / 180 * Math.PI);
         ctx.drawImage(img, -img.width / 2, -img.height / 2);
-        if (robot.accelerate_progress) {
-            const exhaustImg = exhaustImages[robot.accelerate_progress];
+        const accelerateProgress = advanceAnimation(robots.accelerate_progress[i], steps, exhaustImages.length);
+        if (accelerateProgress) {
+            const exhaustImg = exhaustImages[accelerateProgress];
             ctx.drawImage(exhaustImg, -exhaustImg.width / 2, img.height / 2 - exhaustImg.height / 2);
         }
 
         // Draw the turret
         const imgDim = turretImage.height;
-        const idx = robot.firing_progress || 0;
-        ctx.rotate(robot.turret_angle / 180 * Math.PI);
+        const idx = advanceAnimation(robots.firing_progress[i], steps, turretImage.width / imgDim) || 0;
+        ctx.rotate(turretAngle / 180 * Math.PI);
         ctx.drawImage(turretImage, imgDim*idx, 0, imgDim, imgDim, -imgDim / 2, -imgDim / 2, imgDim, imgDim);
-        // ctx.drawImage(turretImage, -turretImage.width / 2, -turretImage.height / 2);
         ctx.restore();
-    });
+    }
 
-    arena.missiles.forEach(missile => {
-        const laserScale = SCALE * (0.1 + 0.9 * missile.energy / 5);
-        if (!missile.exploding) {
+    const missiles = arena.missiles;
+    for (let i = 0; i < missiles.length; i++) {
+        const laserScale = SCALE * (0.1 + 0.9 * missiles.energy[i] / 5);
+        const angle = missiles.angle[i] / 180 * Math.PI;
+        const distance = missiles.exploding[i] ? 0 : ahead * arena.missile_velocity;
+        const dx = missiles.position.x[i] + distance * Math.cos(angle);
+        const dy = missiles.position.y[i] + distance * Math.sin(angle);
+        if (!missiles.exploding[i]) {
             const img = laserImage;
             const imgDim = laserImage.height;
             const idx = Math.round(timestamp*.02) % (img.width / imgDim);
-            const dx = missile.position.x;
-            const dy = missile.position.y;
 
             ctx.save();
             ctx.translate(dx, dy);
             ctx.scale(laserScale, laserScale)
-            ctx.rotate(Math.PI / 2 + missile.angle / 180 * Math.PI);
+            ctx.rotate(Math.PI / 2 + angle);
             ctx.drawImage(img, imgDim*idx, 0, imgDim, imgDim, -imgDim / 2, -imgDim / 2, imgDim, imgDim);
             ctx.restore();
 
         } else {
             const img = explosionImage;
             const imgDim = explosionImage.height;
-            const idx = missile.explode_progress;
-            const dx = missile.position.x
-            const dy = missile.position.y
+            const idx = advanceAnimation(missiles.explode_progress[i], steps, img.width / imgDim);
+            if (Number.isNaN(idx)) {
+                continue;
+            }
             ctx.save();
             ctx.translate(dx, dy);
             ctx.scale(laserScale * 2, laserScale * 2)
             ctx.drawImage(img, imgDim*idx, 0, imgDim, imgDim, -imgDim / 2, -imgDim / 2, imgDim, imgDim);
             ctx.restore();
         }
-    });
+    }
+    ctx.restore();
+
+    // Viewport-filtered states carry the total robot count, as not all robots are sent
+    const numRobots = _.isNumber(arena.num_robots) ? arena.num_robots : robots.length;
+    if (isLargeArena()) {
+        ctx.fillStyle = 'white';
+        ctx.font = '16px monospace';
+        ctx.textAlign = 'left';
+        ctx.fillText(`${numRobots} robots - viewing (${Math.round(viewport.x)}, ${Math.round(viewport.y)}) of ${arena.width}x${arena.height} - drag or use arrow keys to pan`, 10, 990);
+    }
 
-    if (arena.robots.length === 0) {
+    if (numRobots === 0) {
         ctx.fillStyle = 'red';
         ctx.font = '64px monospace';
         ctx.textAlign = 'center';
         ctx.fillText(`Waiting for players`, 500, 500);
-        window.requestAnimationFrame(draw);
     }
 
     if (arena.winner) {
@@ -249,6 +397,5 @@ function draw(timestamp) {
         if (!leaderboardUpdated) {
             updateLeaderboard();
         }
-        window.requestAnimationFrame(draw);
     }
 }
@@ -0,0 +1,44 @@
+// Web worker which decodes arena state messages off the main thread.
+//
+// The server sends lists of objects transposed into columns, marked with "_t". Rather than zipping these back
+// into objects, each column is kept as-is: numeric columns become typed arrays (null becomes NaN) whose buffers
+// are transferred to the main thread without copying, and other columns stay as plain arrays.
+
+function decodeColumn(values, transfer) {
+    if (!Array.isArray(values)) {
+        return decodeTable(values, transfer);
+    }
+    if (!values.every(v => v === null || typeof v === "number")) {
+        return values;
+    }
+    const column = new Float64Array(values.length);
+    for (let i = 0; i < values.length; i++) {
+        column[i] = values[i] === null ? NaN : values[i];
+    }
+    transfer.push(column.buffer);
+    return column;
+}
+
+function decodeTable(obj, transfer) {
+    // An empty list isn't transposed
+    if (Array.isArray(obj)) {
+        return {length: obj.length};
+    }
+    const table = {length: 0};
+    for (const key in obj) {
+        if (key === "_t") {
+            continue;
+        }
+        table[key] = decodeColumn(obj[key], transfer);
+        table.length = table[key].length;
+    }
+    return table;
+}
+
+onmessage = function (event) {
+    const state = JSON.parse(event.data);
+    const transfer = [];
+    state.robots = decodeTable(state.robots, transfer);
+    state.missiles = decodeTable(state.missiles, transfer);
+    postMessage(state, transfer);
+};
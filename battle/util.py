@@ -1,8 +1,24 @@
+import asyncio
 import json
-from dataclasses import asdict
-from typing import Any, Dict
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Deque, Dict, Iterator, Optional
+
+from aiohttp import WSCloseCode, web
 
 from battle.arena import Arena
+from battle.robots import GameParameters, Position
+
+# Entities this far outside a spectator's viewport are still sent, so they don't pop in at the edges
+VIEWPORT_MARGIN = 100
+# Frames waiting to be sent to each spectator. Once full, the oldest are dropped so the latest frame is sent next.
+SPECTATOR_QUEUE_LEN = 4
+# Spectators who haven't accepted a frame for this many seconds are disconnected
+SPECTATOR_STALL_TIMEOUT = 10
+# Approximate memory held by each delay line frame, plus each robot or missile in it, as measured with deep_sizeof
+FRAME_BYTES = 1000
+FRAME_OBJECT_BYTES = 900
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -25,6 +41,160 @@ class JSONEncoder(json.JSONEncoder):
         return super().encode(a)
 
 
-def state_as_json(arena: Arena):
-    d = asdict(arena)
+@dataclass
+class Viewport:
+    """The region of the arena a spectator is currently looking at"""
+
+    x: float
+    y: float
+    width: float
+    height: float
+
+    def contains(self, position: Position, margin: float = VIEWPORT_MARGIN) -> bool:
+        """Returns whether the position is within the viewport, extended by `margin` on each side"""
+        return (
+            self.x - margin <= position.x <= self.x + self.width + margin
+            and self.y - margin <= position.y <= self.y + self.height + margin
+        )
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Viewport":
+        return cls(**{k: float(d[k]) for k in ("x", "y", "width", "height")})
+
+
+def playback_rate(lag: int) -> float:
+    """Returns the frame rate multiplier for a spectator that is `lag` frames behind where it should be, speeding
+    up slightly to catch up or slowing down slightly if ahead"""
+    if lag > 0:
+        return 1.1
+    elif lag < 0:
+        return 0.99
+    return 1
+
+
+def turn_rate(angle: float, prior_angle: float) -> float:
+    """Returns the change from one angle to another in degrees, taking the shortest way around"""
+    return (angle - prior_angle + 180.0) % 360.0 - 180.0
+
+
+def state_as_json(arena: Arena, viewport: Optional[Viewport] = None, stride: int = 1, prior: Optional[Arena] = None):
+    """Serializes the arena state. If a viewport is given, only robots and missiles in or near it are included.
+
+    Spectators sent every `stride` frames extrapolate the frames in between, so each robot's hull and turret turn
+    rates are included, measured from the `prior` frame, along with the stride, frame rate and missile velocity."""
+    if viewport is None:
+        d = asdict(arena)
+    else:
+        visible = replace(
+            arena,
+            robots=[r for r in arena.robots if viewport.contains(r.position)],
+            missiles=[m for m in arena.missiles if viewport.contains(m.position)],
+        )
+        d = asdict(visible)
+        d["num_robots"] = len(arena.robots)
+    if stride > 1:
+        prior_robots = {r.name: r for r in prior.robots} if prior is not None else {}
+        for r in d["robots"]:
+            p = prior_robots.get(r["name"])
+            r["hull_rate"] = turn_rate(r["hull_angle"], p.hull_angle) if p is not None else 0.0
+            r["turret_rate"] = turn_rate(r["turret_angle"], p.turret_angle) if p is not None else 0.0
+        d["stride"] = stride
+        d["fps"] = GameParameters.FPS
+        d["missile_velocity"] = GameParameters.BULLET_VELOCITY
     return json.dumps(d, separators=(",", ":"), cls=JSONEncoder)
+
+
+class DelayLine:
+    """The arena states of a match, oldest first. Frames are indexed by their position since the start of the match,
+    like a list, but if `maxlen` is set only the newest `maxlen` frames are kept. The length includes dropped frames,
+    and indexing a dropped frame returns the oldest frame that is kept."""
+
+    def __init__(self, maxlen: Optional[int] = None):
+        self.frames: Deque[Arena] = deque(maxlen=maxlen)
+        # The index of the oldest frame that is kept
+        self.first = 0
+        # The number of robots and missiles in the frames that are kept
+        self.objects = 0
+
+    @property
+    def maxlen(self) -> Optional[int]:
+        return self.frames.maxlen
+
+    def append(self, arena: Arena) -> None:
+        if len(self.frames) == self.frames.maxlen:
+            self.first += 1
+            self.objects -= len(self.frames[0].robots) + len(self.frames[0].missiles)
+        self.frames.append(arena)
+        self.objects += len(arena.robots) + len(arena.missiles)
+
+    def clear(self) -> None:
+        self.frames.clear()
+        self.first = 0
+        self.objects = 0
+
+    def approx_bytes(self) -> int:
+        """Returns the approximate memory held by the frames that are kept, without having to size them"""
+        return FRAME_BYTES * len(self.frames) + FRAME_OBJECT_BYTES * self.objects
+
+    def __len__(self) -> int:
+        return self.first + len(self.frames)
+
+    def __getitem__(self, idx: int) -> Arena:
+        if idx < 0:
+            return self.frames[idx]
+        return self.frames[max(0, idx - self.first)]
+
+    def __iter__(self) -> Iterator[Arena]:
+        return iter(self.frames)
+
+
+class SpectatorStalled(Exception):
+    """The spectator hasn't accepted any frames for too long"""
+
+
+class SpectatorQueue:
+    """A bounded queue of frames waiting to be sent to a single spectator, which is drained by `run`. Frames are
+    paced by the producer, so a slow spectator only loses intermediate frames rather than slowing playback down or
+    building up a backlog."""
+
+    def __init__(self, arena_id: int, maxlen: int = SPECTATOR_QUEUE_LEN):
+        self.arena_id = arena_id
+        self.frames: Deque[str] = deque(maxlen=maxlen)
+        self.sent = 0
+        self.dropped = 0
+        self.last_progress = time.monotonic()
+        self._ready = asyncio.Event()
+
+    def put(self, frame: str) -> None:
+        """Queues a frame, dropping the oldest waiting frame if the queue is full"""
+        now = time.monotonic()
+        if not self.frames:
+            self.last_progress = max(self.last_progress, now)
+        elif now - self.last_progress > SPECTATOR_STALL_TIMEOUT:
+            raise SpectatorStalled
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+        self.frames.append(frame)
+        self._ready.set()
+
+    async def run(self, ws: web.WebSocketResponse) -> None:
+        """Sends queued frames to the spectator as fast as it accepts them"""
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.frames:
+                await ws.send_str(self.frames.popleft())
+                self.sent += 1
+                self.last_progress = time.monotonic()
+
+    async def disconnect(self, request: web.Request, ws: web.WebSocketResponse) -> None:
+        """Disconnects a stalled spectator, dropping the connection if it won't close cleanly"""
+        print(f"Disconnecting stalled spectator of arena {self.arena_id}, {self.dropped} frames dropped")
+        try:
+            await asyncio.wait_for(ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"Too slow"), timeout=1)
+        except asyncio.TimeoutError:
+            if request.transport is not None:
+                request.transport.abort()
+
+    def stats(self) -> Dict[str, int]:
+        return {"arena_id": self.arena_id, "queued": len(self.frames), "sent": self.sent, "dropped": self.dropped}